@@ -1,18 +1,49 @@
 import re
+import csv
+import base64
+import copy
 import json
+import os
+import difflib
+import hashlib
+import multiprocessing
 import sys
 import shlex
+import signal
+import time
+import threading
+import traceback
+import webbrowser
 import subprocess as sp
 from pathlib import Path
-from datetime import datetime
-from collections import defaultdict
+from datetime import date as date_type, datetime, time as time_type
+from functools import lru_cache, partial, singledispatch
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from html import escape
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from textwrap import shorten
 from typing import *
 
+try:
+    import resource
+except ImportError:
+    # windows; notebooks are rendered without limits
+    resource = None
+
 import nbformat
 
+import pygments
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import TextLexer, get_lexer_by_name
+from pygments.util import ClassNotFound
+
 from nbconvert import MarkdownExporter
 from nbconvert.preprocessors import Preprocessor
 
+from traitlets import Bool, Dict as DictTrait, Integer, List as ListTrait, Set as SetTrait, Unicode
 from traitlets.config import Config
 
 from watchdog.events import PatternMatchingEventHandler
@@ -20,55 +51,284 @@ from watchdog.observers import Observer
 
 import crayons
 
+try:
+    from PIL import Image
+except ImportError:
+    # images are still extracted without Pillow, just not optimized
+    Image = None
+
 from fabric.api import *
 
+# where hugo-jupyter keeps its state between runs
+STATE_DIR = Path('.hugo_jupyter')
+RENDER_TIMES_FILE = STATE_DIR / 'render-times.json'
+SHARDS_DIR = STATE_DIR / 'shards'
+HIGHLIGHT_CACHE_DIR = STATE_DIR / 'highlight'
+SEARCH_STATE_FILE = STATE_DIR / 'search-index.json'
+FAILURES_FILE = STATE_DIR / 'failures.json'
+VALIDATIONS_FILE = STATE_DIR / 'validations.json'
+# the client-side search index, served by hugo
+SEARCH_INDEX_FILE = Path('static', 'hugo-jupyter', 'search-index.json')
+
+# default limits on rendering a single notebook, in seconds and megabytes
+RENDER_TIMEOUT = 300
+RENDER_MEMORY_LIMIT = 4096
+# how many times in a row a notebook may fail to render before it's quarantined
+QUARANTINE_AFTER = 3
+# port the watcher serves prometheus metrics on
+METRICS_PORT = 9717
+# git ref pointing at the commit that was last published
+PUBLISHED_REF = 'refs/hugo-jupyter/published'
+
+
 @task
 def update_notebooks_metadata():
     """Update all the notebooks' metadata fields."""
     notebooks = Path('notebooks').glob('*.ipynb')
     for notebook in notebooks:
-        if (not str(notebook).startswith('.')) and ('untitled' not in str(notebook).lower()):
+        if is_renderable(notebook):
             yield update_notebook_metadata(notebook)
 
 @task
-def render_notebooks():
+def render_notebooks(shard=None, since=None, search_index=False, timeout=RENDER_TIMEOUT, memory_limit=RENDER_MEMORY_LIMIT,
+                     retry_quarantined=False, validation='cached'):
     """
     Render jupyter notebooks it notebooks directory to respective markdown in content/post directory.
+
+    Each notebook is rendered in a worker process with a time and memory limit. A notebook that
+    fails doesn't stop the others; failures are reported at the end, and notebooks that keep
+    failing are quarantined (skipped) until they render successfully again.
+
+    Args:
+        shard: render only one of N balanced parts of the notebooks, given as `i/N` with i counting from 1,
+               so a render can be spread across machines; check the union with `merge_shards`.
+               Every machine must have the same render times file, or they partition differently
+        since: a git ref; only render notebooks changed between it and HEAD,
+               and remove the posts of notebooks deleted, renamed, or given a new slug or render-to since
+        search_index: update the search index in hugo's static directory (not done by shards; see `merge_shards`)
+        timeout: seconds a notebook may take to render; 0 for no limit
+        memory_limit: megabytes of memory a notebook's render may use; 0 for no limit
+        retry_quarantined: also render quarantined notebooks
+        validation: 'full' validates every notebook, 'cached' only those that changed since they were
+                    last validated, and 'skip' none; invalid notebooks are reported, not skipped
+    """
+    assert not (shard and since), 'a render can either be sharded or incremental, not both'
+    notebooks = notebooks_to_render()
+    if since:
+        changed, removed = changed_notebooks(since)
+        remove_stale_posts(since, removed, changed)
+        notebooks = [notebook for notebook in notebooks if notebook in changed]
+    if shard:
+        index, count = parse_shard(shard)
+        notebooks = partition_notebooks(notebooks, count, render_weights(notebooks))[index - 1]
+
+    limits = RenderLimits(float(timeout), int(memory_limit))
+    failures = RenderFailures()
+    rendered, times = {}, {}
+    for notebook in notebooks:
+        if failures.is_quarantined(notebook) and not true(retry_quarantined):
+            print(crayons.yellow('skipping quarantined notebook {}'.format(notebook)))
+            continue
+        start = time.time()
+        try:
+            rendered[notebook] = write_hugo_formatted_nb_to_md(notebook, limits=limits, validation=validation)
+        except Exception as e:
+            failures.record(notebook, e)
+            continue
+        failures.clear(notebook)
+        times[notebook.as_posix()] = time.time() - start
+
+    # shards leave the recorded times alone so they all partition with the same weights;
+    # merge_shards records them once every shard is done
+    if shard:
+        write_shard_manifest(index, count, rendered, times)
+    else:
+        record_render_times(times)
+        if true(search_index):
+            SearchIndex().update(notebooks_to_render())
+
+    NotebookValidations().report(notebooks)
+    failures.report(notebooks)
+
+
+@task
+def validate_notebooks(validation='full'):
+    """
+    Validate all the notebooks against the notebook format's json schema and report every invalid one.
+
+    Notebooks that can't even be read, e.g. because they aren't valid json, are reported along with the rest.
+
+    Args:
+        validation: 'full' validates every notebook, 'cached' only those that changed since they were last validated
     """
-    for notebook in update_notebooks_metadata():
-        write_hugo_formatted_nb_to_md(notebook)
+    notebooks = notebooks_to_render()
+    validations = NotebookValidations()
+    for notebook in notebooks:
+        try:
+            notebook_node = nbformat.convert(nbformat.reader.reads(notebook.read_text()), 4)
+        except Exception as e:
+            validations.record_unreadable(notebook, e)
+            continue
+        validations.validate(notebook, notebook_node, validation)
+    if validations.report(notebooks):
+        abort('invalid notebooks found')
+    print(crayons.green('{} notebook(s) are valid'.format(len(notebooks))))
 
 
 @task
-def serve(hugo_args='', init_jupyter=True):
+def clear_quarantine(notebook=None):
+    """
+    Forget the render failures of a notebook, or of all notebooks, taking them out of quarantine.
+
+    Args:
+        notebook: path to the notebook; all notebooks if not given
+    """
+    failures = RenderFailures()
+    for failed in [Path(notebook)] if notebook else [Path(failed) for failed in list(failures.records)]:
+        failures.clear(failed)
+    print(crayons.green('cleared render failures'))
+
+
+@task
+def merge_shards(shards_dir=SHARDS_DIR, search_index=False):
+    """
+    Check that the shards of a sharded render add up to the whole site before running hugo.
+
+    Every notebook must have been rendered by exactly one shard, no two notebooks may
+    be rendered to the same post, and every post must exist.
+
+    Args:
+        shards_dir: directory the shards' manifests were collected in
+        search_index: update the search index in hugo's static directory
+    """
+    manifests = [json.loads(path.read_text()) for path in sorted(Path(shards_dir).glob('*.json'))]
+    errors = shard_errors(manifests, notebooks_to_render())
+    if errors:
+        for error in errors:
+            print(crayons.red(error))
+        abort('{} problem(s) found merging {} shard(s)'.format(len(errors), len(manifests)))
+
+    record_render_times({notebook: seconds for manifest in manifests for notebook, seconds in manifest['times'].items()})
+    if true(search_index):
+        SearchIndex().update(notebooks_to_render())
+    print(crayons.green('{} shard(s) rendered {} notebook(s)'.format(
+        len(manifests), sum(len(manifest['rendered']) for manifest in manifests))))
+
+
+@task
+def update_front_matter(manifest=None, notebooks='notebooks', dry_run=False, workers=8, patch_rendered=True, **changes):
+    """
+    Change the front matter of many notebooks at once.
+
+    Changes are read from a csv or toml manifest and/or passed as keyword arguments,
+    e.g. `fab update_front_matter:notebooks=notebooks/drafts,draft=true,tags=python;hugo`.
+    Passing an empty value, e.g. `subtitle=`, removes that key.
+    Posts that were already rendered have their front matter patched in place, without re-rendering.
+
+    Args:
+        manifest: path to a .csv or .toml manifest of changes (see `read_front_matter_manifest`)
+        notebooks: glob pattern or directory of notebooks the keyword argument changes apply to
+        dry_run: print a diff of the changes instead of writing them
+        workers: number of threads used to read and write notebooks
+        patch_rendered: patch the front matter of already-rendered posts
+    """
+    planned: Dict[Path, dict] = defaultdict(dict)
+    if manifest:
+        for pattern, manifest_changes in read_front_matter_manifest(manifest):
+            for notebook in find_notebooks(pattern):
+                planned[notebook].update(manifest_changes)
+    if changes:
+        for notebook in find_notebooks(notebooks):
+            planned[notebook].update(changes)
+
+    # a notebook that fails doesn't stop the others; every notebook that was written still gets trusted
+    written: List[Path] = []
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        futures = {notebook: executor.submit(plan_front_matter_update, notebook, notebook_changes,
+                                                   true(dry_run), true(patch_rendered), written)
+                   for notebook, notebook_changes in planned.items()}
+        for notebook, future in futures.items():
+            try:
+                results[notebook] = future.result()
+            except Exception as e:
+                errors[notebook] = e
+
+    changed = [notebook for notebook, (old, new) in sorted(results.items()) if old != new]
+
+    if true(dry_run):
+        for notebook in changed:
+            print(front_matter_diff(notebook, *results[notebook]))
+        print(crayons.yellow('dry run: {} of {} notebook(s) would change'.format(len(changed), len(planned))))
+    else:
+        # one `jupyter trust` for the whole batch instead of one per notebook
+        trust_notebooks(sorted(written))
+        print(crayons.green('updated front matter of {} of {} notebook(s)'.format(len(changed), len(planned))))
+
+    if errors:
+        for notebook, error in sorted(errors.items()):
+            print(crayons.red('{}: {}: {}'.format(notebook, type(error).__name__, error)))
+        abort('failed to update the front matter of {} notebook(s)'.format(len(errors)))
+
+
+@task
+def serve(hugo_args='', init_jupyter=True, render_to_memory=True, navigate_to_changed=True, open_browser=True,
+          search_index=False, timeout=RENDER_TIMEOUT, memory_limit=RENDER_MEMORY_LIMIT,
+          metrics_port=METRICS_PORT, summary_interval=300, validation='cached'):
     """
     Watch for changes in jupyter notebooks and render them anew while hugo runs.
 
     Args:
         init_jupyter: initialize jupyter if set to True
         hugo_args: command-line arguments to be passed to `hugo server`
+        render_to_memory: have hugo serve from memory rather than writing the site to disk
+        navigate_to_changed: have the browser navigate to the post that was just rendered
+        open_browser: open the site in a web browser
+        search_index: keep the search index in hugo's static directory up to date
+        timeout: seconds a notebook may take to render; 0 for no limit
+        memory_limit: megabytes of memory a notebook's render may use; 0 for no limit
+        metrics_port: serve prometheus metrics at http://localhost:<port>/metrics; 0 to disable
+        summary_interval: print a summary of the metrics every this many seconds; 0 to disable
+        validation: notebook validation policy, 'full', 'cached', or 'skip'
     """
     observer = Observer()
-    observer.schedule(NotebookHandler(), 'notebooks')
+    observer.schedule(NotebookHandler(search_index=SearchIndex() if true(search_index) else None,
+                                      limits=RenderLimits(float(timeout), int(memory_limit)),
+                                      validation=validation),
+                      'notebooks')
     observer.start()
 
-    hugo_process = sp.Popen(('hugo', 'serve', *shlex.split(hugo_args)))
+    METRICS.gauge('hugo_jupyter_queue_depth', observer.event_queue.qsize)
+    if int(metrics_port):
+        serve_metrics(int(metrics_port))
+
+    hugo_command = ['hugo', 'serve', *shlex.split(hugo_args)]
+    if true(render_to_memory):
+        hugo_command.append('--renderToMemory')
+    if true(navigate_to_changed):
+        hugo_command.append('--navigateToChanged')
+    hugo_process = sp.Popen(hugo_command)
 
-    if init_jupyter:
+    if true(init_jupyter):
         jupyter_process = sp.Popen(('jupyter', 'notebook'), cwd='notebooks')
 
-    local('open http://localhost:1313')
+    if true(open_browser):
+        webbrowser.open('http://localhost:1313')
 
     try:
         print(crayons.green('Successfully initialized server(s)'),
               crayons.yellow('press ctrl+C at any time to quit'),
               )
+        last_summary = time.time()
         while True:
-            pass
+            time.sleep(1)
+            if int(summary_interval) and time.time() - last_summary >= int(summary_interval):
+                print(crayons.blue(METRICS.summary()))
+                last_summary = time.time()
     except KeyboardInterrupt:
         print(crayons.yellow('Terminating'))
     finally:
-        if init_jupyter:
+        if true(init_jupyter):
             print(crayons.yellow('shutting down jupyter'))
             jupyter_process.kill()
 
@@ -82,7 +342,7 @@ def serve(hugo_args='', init_jupyter=True):
 
 
 @task
-def publish():
+def publish(incremental=True):
     """
     Publish notebook to github pages.
 
@@ -91,6 +351,9 @@ def publish():
     https://help.github.com/articles/user-organization-and-project-pages/
     and that you're using the master branch only
     to have the rendered content of your blog.
+
+    Args:
+        incremental: only re-render notebooks changed since the last publish
     """
     with settings(warn_only=True):
         if local('git diff-index --quiet HEAD --').failed:
@@ -110,7 +373,7 @@ def publish():
     local('rm -rf public/*')
 
     # generating site
-    render_notebooks()
+    render_notebooks(since=last_published_commit() if true(incremental) else None)
     local('hugo')
 
     # commit
@@ -122,23 +385,40 @@ def publish():
     local('git push upstream master')
     print('push succeeded')
 
+    # remember what was published, so the next publish only renders what changed since
+    local('git update-ref {} HEAD'.format(PUBLISHED_REF))
+
 
 ########## Jupyter stuff #################
 
 class CustomPreprocessor(Preprocessor):
-    """Remove blank code cells and unnecessary whitespace."""
+    """Remove blank or hidden cells and unnecessary whitespace."""
+
+    remove_tags = SetTrait({'remove', 'hide'},
+                           help="Cells carrying any of these tags are dropped from the output").tag(config=True)
 
     def preprocess(self, nb, resources):
         """
-        Remove blank cells
+        Remove blank and hidden cells in a single pass over the notebook
         """
-        for index, cell in enumerate(nb.cells):
-            if cell.cell_type == 'code' and not cell.source:
-                nb.cells.pop(index)
-            else:
-                nb.cells[index], resources = self.preprocess_cell(cell, resources, index)
+        cells = []
+        for cell in nb.cells:
+            if self.is_removable(cell):
+                continue
+            cell, resources = self.preprocess_cell(cell, resources, len(cells))
+            cells.append(cell)
+        nb.cells = cells
         return nb, resources
 
+    def is_removable(self, cell) -> bool:
+        """
+        Return True if the cell is a blank code/markdown cell or is tagged for removal
+        """
+        if cell.cell_type in ('code', 'markdown') and not cell.source.strip():
+            return True
+        tags = cell.get('metadata', {}).get('tags', ())
+        return not self.remove_tags.isdisjoint(tags)
+
     def preprocess_cell(self, cell, resources, cell_index):
         """
         Remove extraneous whitespace from code cells' source code
@@ -149,6 +429,265 @@ class CustomPreprocessor(Preprocessor):
         return cell, resources
 
 
+class ScriptBundlePreprocessor(Preprocessor):
+    """
+    Move large inline scripts (plotly, bokeh, ipywidgets, ...) out of the notebook's outputs into static files.
+
+    Each distinct script is written once to hugo's static directory, named by the hash of its
+    content, and every inline copy is replaced by a single `<script src>` per page.
+    """
+
+    static_dir = Unicode('static', help="hugo's static directory").tag(config=True)
+    bundle_dir = Unicode('hugo-jupyter/bundles', help="Where bundles are written, relative to static_dir").tag(config=True)
+    min_size = Integer(20000, help="Inline scripts smaller than this many characters are left alone").tag(config=True)
+    libraries = DictTrait({
+        'plotly': r'plotly\.js v?\d',
+        'bokeh': r'Bokeh\b',
+        'ipywidgets': r'@jupyter-widgets',
+        'requirejs': r'RequireJS',
+        'vega': r'vega-embed|vega-lite',
+    }, help="Names of known libraries and regexes identifying them, used to name their bundles").tag(config=True)
+
+    inline_script = re.compile(r'<script\b(?P<attrs>[^>]*)>(?P<body>.*?)</script>', re.DOTALL | re.IGNORECASE)
+    script_type = re.compile(r'\btype\s*=\s*["\']?(?P<type>[^"\'\s>]+)', re.IGNORECASE)
+
+    def preprocess(self, nb, resources):
+        """
+        Replace large inline scripts in code cells' outputs, remembering which were already included in this page
+        """
+        included = set()
+        for cell in nb.cells:
+            for output in cell.get('outputs', ()):
+                data = output.get('data', {})
+                if 'text/html' in data:
+                    data['text/html'] = self.inline_script.sub(
+                        lambda match: self.replace_script(match, included), data['text/html'])
+                elif len(data.get('application/javascript', '')) >= self.min_size:
+                    # markdown can't display javascript outputs, but it can load the library as html
+                    data['text/html'] = self.script_tag(data['application/javascript'], included)
+        return nb, resources
+
+    def replace_script(self, match, included: Set[str]) -> str:
+        attrs, body = match.group('attrs'), match.group('body')
+        script_type = self.script_type.search(attrs)
+        if ('src' in attrs.lower() or len(body) < self.min_size
+                or (script_type and 'javascript' not in script_type.group('type').lower())):
+            return match.group(0)
+        return self.script_tag(body, included)
+
+    def script_tag(self, script: str, included: Set[str]) -> str:
+        """Return the `<script src>` tag for a bundle, or nothing if this page already includes it."""
+        url = self.write_bundle(script)
+        if url in included:
+            return ''
+        included.add(url)
+        return '<script src="{}"></script>'.format(url)
+
+    def write_bundle(self, script: str) -> str:
+        """Write the script to the static directory unless a bundle with the same content exists; return its url."""
+        library = next((name for name, pattern in self.libraries.items() if re.search(pattern, script)), 'bundle')
+        name = '{}-{}.js'.format(library, hashlib.sha1(script.encode()).hexdigest()[:16])
+        bundle = Path(self.static_dir, self.bundle_dir, name)
+        if not bundle.exists():
+            bundle.parent.mkdir(parents=True, exist_ok=True)
+            part_file = bundle.with_name(bundle.name + '.part{}'.format(threading.get_ident()))
+            part_file.write_text(script)
+            part_file.replace(bundle)
+        return '/{}/{}'.format(self.bundle_dir.strip('/'), name)
+
+
+IMAGE_FORMATS = {'image/png': 'png', 'image/jpeg': 'jpeg'}
+
+
+def optimize_image(source: bytes, name: str, image_dir: str, fmt: str, widths: List[int], webp: bool) -> dict:
+    """
+    Write an image and its responsive variants to image_dir.
+
+    With Pillow installed, the image is recompressed and resized to each width narrower
+    than the original, optionally also as webp; without it, the original is written as-is.
+    Runs in a worker process, so it only takes and returns plain data.
+
+    Returns: {'width': original width or None, 'variants': {format: [[width or None, filename], ...]}}
+    """
+    image_dir = Path(image_dir)
+    image_dir.mkdir(parents=True, exist_ok=True)
+
+    if Image is None:
+        filename = '{}.{}'.format(name, fmt)
+        (image_dir / filename).write_bytes(source)
+        return {'width': None, 'variants': {fmt: [[None, filename]]}}
+
+    image = Image.open(BytesIO(source))
+    image.load()
+    targets = sorted({width for width in widths if width < image.width} | {image.width})
+    variants: Dict[str, List[list]] = defaultdict(list)
+    for width in targets:
+        resized = image if width == image.width else image.resize(
+            (width, round(image.height * width / image.width)), Image.LANCZOS)
+        for variant_format in (fmt, 'webp') if webp else (fmt,):
+            filename = '{}-{}.{}'.format(name, width, variant_format)
+            options = {'optimize': True} if variant_format == 'png' else {'quality': 85}
+            if variant_format == 'jpeg' and resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+            resized.save(str(image_dir / filename), variant_format.upper(), **options)
+            variants[variant_format].append([width, filename])
+    return {'width': image.width, 'height': image.height, 'variants': dict(variants)}
+
+
+class ImagePreprocessor(Preprocessor):
+    """
+    Move png and jpeg outputs out of the notebook into optimized, responsive, lazily-loaded static images.
+
+    Images are processed across a process pool and cached by the hash of the source image
+    and the settings they were processed with, so re-renders never redo work.
+    """
+
+    static_dir = Unicode('static', help="hugo's static directory").tag(config=True)
+    image_dir = Unicode('hugo-jupyter/images', help="Where images are written, relative to static_dir").tag(config=True)
+    widths = ListTrait(Integer(), [480, 960], help="Widths of the responsive variants, in pixels").tag(config=True)
+    webp = Bool(True, help="Also write webp variants").tag(config=True)
+    lazy = Bool(True, help="Have browsers load images lazily").tag(config=True)
+    workers = Integer(None, allow_none=True, help="Number of worker processes; defaults to the cpu count").tag(config=True)
+
+    def preprocess(self, nb, resources):
+        """
+        Process each distinct uncached image once, in parallel, then replace the outputs with html
+
+        Outputs that already have an html representation are left alone.
+        """
+        outputs = [(output, mimetype) for cell in nb.cells for output in cell.get('outputs', ())
+                   for mimetype in IMAGE_FORMATS
+                   if mimetype in output.get('data', {}) and 'text/html' not in output['data']]
+        images = {}
+        for output, mimetype in outputs:
+            source = base64.b64decode(output['data'][mimetype])
+            images.setdefault(self.image_name(source), (source, IMAGE_FORMATS[mimetype]))
+
+        processed = {name: self.cached(name) for name in images}
+        pending = {name: image for name, image in images.items() if processed[name] is None}
+        directory = str(Path(self.static_dir, self.image_dir))
+        jobs = [(source, name, directory, fmt, list(self.widths), self.webp) for name, (source, fmt) in pending.items()]
+        if len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(optimize_image, *zip(*jobs)))
+        else:
+            results = [optimize_image(*job) for job in jobs]
+        for name, result in zip(pending, results):
+            Path(directory, name + '.json').write_text(json.dumps(result))
+            processed[name] = result
+
+        for output, mimetype in outputs:
+            name = self.image_name(base64.b64decode(output['data'].pop(mimetype)))
+            output['data']['text/html'] = self.image_html(processed[name], IMAGE_FORMATS[mimetype],
+                                                          output['data'].get('text/plain', ''))
+        return nb, resources
+
+    def image_name(self, source: bytes) -> str:
+        """Name an image by the hash of its content and the settings it's processed with."""
+        settings_key = json.dumps([list(self.widths), self.webp, Image is not None]).encode()
+        return hashlib.sha1(source + settings_key).hexdigest()[:16]
+
+    def cached(self, name: str) -> Optional[dict]:
+        """Return the result of processing the image earlier, if its files are still there."""
+        record = Path(self.static_dir, self.image_dir, name + '.json')
+        if not record.exists():
+            return None
+        result = json.loads(record.read_text())
+        filenames = [filename for variants in result['variants'].values() for _, filename in variants]
+        if all(Path(self.static_dir, self.image_dir, filename).exists() for filename in filenames):
+            return result
+        return None
+
+    def image_html(self, result: dict, fmt: str, alt: str = '') -> str:
+        """
+        Return the `<img>` (or `<picture>`, with webp variants) tag for a processed image.
+
+        The alt text is the output's plain text representation, if it has one.
+        """
+        def url(filename):
+            return '/{}/{}'.format(self.image_dir.strip('/'), filename)
+
+        def srcset(variants):
+            return ', '.join('{} {}w'.format(url(filename), width) for width, filename in variants)
+
+        variants = result['variants'][fmt]
+        attributes = ['src="{}"'.format(url(variants[-1][1])), 'alt="{}"'.format(escape(alt.strip(), quote=True))]
+        if result['width']:
+            sizes = '(max-width: {0}px) 100vw, {0}px'.format(result['width'])
+            attributes += ['srcset="{}"'.format(srcset(variants)), 'sizes="{}"'.format(sizes),
+                           'width="{}"'.format(result['width']), 'height="{}"'.format(result['height'])]
+        if self.lazy:
+            attributes.append('loading="lazy"')
+        img = '<img {}>'.format(' '.join(attributes))
+        if 'webp' not in result['variants']:
+            return img
+        return '<picture><source type="image/webp" srcset="{}" sizes="{}">{}</picture>'.format(
+            srcset(result['variants']['webp']), sizes, img)
+
+
+@lru_cache(maxsize=4096)
+def highlight_source(source: str, language: str, style: str, noclasses: bool) -> str:
+    """
+    Highlight source code as hugo-style html, cached in memory and under the state directory.
+
+    The cache is keyed by the hash of the source, the lexer and the style, so a cell is only
+    ever highlighted once, however many notebooks or runs it appears in.
+    """
+    try:
+        lexer = get_lexer_by_name(language)
+    except ClassNotFound:
+        lexer = TextLexer()
+    key = json.dumps([source, lexer.name, style, noclasses])
+    cached = Path(HIGHLIGHT_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.html')
+    if cached.exists():
+        return cached.read_text()
+
+    formatter = HtmlFormatter(style=style, noclasses=noclasses, cssclass='highlight')
+    html = pygments.highlight(source, lexer, formatter).strip()
+    # wrap the code in <code> like hugo does; the formatter's wrapcode option needs Pygments 2.4
+    html = re.sub(r'(<pre[^>]*>(<span></span>)?)', r'\1<code class="language-{0}" data-lang="{0}">'.format(language),
+                  html, count=1)
+    html = '</code></pre>'.join(html.rsplit('</pre>', 1))
+    # a blank line would end the html block in markdown, so give blank lines an empty element
+    html = re.sub(r'^([ \t]*)$', r'\1<span></span>', html, flags=re.MULTILINE)
+
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    part_file = cached.with_name(cached.name + '.part{}'.format(threading.get_ident()))
+    part_file.write_text(html)
+    part_file.replace(cached)
+    return html
+
+
+class HighlightPreprocessor(Preprocessor):
+    """
+    Highlight code cells with Pygments at render time, so hugo doesn't have to on every build.
+
+    Each code cell's source is replaced by the highlighted html, in the language of the notebook's kernel.
+    """
+
+    style = Unicode('default', help="Pygments style").tag(config=True)
+    noclasses = Bool(True, help="Use inline styles rather than css classes, like hugo's default").tag(config=True)
+
+    def preprocess(self, nb, resources):
+        """
+        Put a markdown cell with the highlighted source in front of each code cell, whose source is then hidden
+        """
+        language = (nb.metadata.get('kernelspec', {}).get('language')
+                    or nb.metadata.get('language_info', {}).get('name')
+                    or 'python')
+        cells = []
+        for cell in nb.cells:
+            if cell.cell_type == 'code' and cell.source:
+                cell_language = cell.metadata.get('magics_language') or language
+                html = highlight_source(cell.source, cell_language, self.style, self.noclasses)
+                cells.append(nbformat.v4.new_markdown_cell(html))
+                # nbconvert 5 reads transient from the cell, later versions from its metadata
+                cell.transient = cell.metadata.transient = {'remove_source': True}
+            cells.append(cell)
+        nb.cells = cells
+        return nb, resources
+
+
 def doctor(string: str) -> str:
     """Get rid of all the wacky newlines nbconvert adds to markdown output and return result."""
     post_code_newlines_patt = re.compile(r'(```)(\n+)')
@@ -160,62 +699,423 @@ def doctor(string: str) -> str:
     return inter_output_filtered
 
 
-def notebook_to_markdown(path: Union[Path, str]) -> str:
+class HugoMarkdownExporter(MarkdownExporter):
+    """
+    A MarkdownExporter that can leave validating the notebook to `load_notebook`.
+
+    nbconvert validates the whole notebook again after every preprocessor, which
+    costs more than the rest of rendering a large notebook put together.
+    """
+
+    validate_preprocessors = Bool(True, help="Validate the notebook after each preprocessor").tag(config=True)
+
+    def _preprocess(self, nb, resources):
+        # nbconvert 5 validates inline here, later versions in a separate hook, so override the whole step
+        if self.validate_preprocessors:
+            return super()._preprocess(nb, resources)
+        nb, resources = copy.deepcopy(nb), copy.deepcopy(resources)
+        for preprocessor in self._preprocessors:
+            nb, resources = preprocessor(nb, resources)
+        return nb, resources
+
+
+def markdown_body(notebook: nbformat.NotebookNode, validation: str = 'full') -> str:
+    """
+    Render the cells of a notebook to hugo-formatted markdown, without front matter.
+
+    Large inline scripts are moved to hugo's static directory unless the notebook's
+    hugo-jupyter.bundle-scripts field is false. Images are optimized into static files if its
+    hugo-jupyter.images field is true, or a dictionary of `ImagePreprocessor` settings, and
+    code cells are highlighted ahead of time if its hugo-jupyter.highlight field is true, or a
+    dictionary of `HighlightPreprocessor` settings.
+
+    Args:
+        notebook: the notebook node
+        validation: the policy the notebook was read with (see `load_notebook`); unless it's 'full',
+                    the notebook isn't validated again after each preprocessor
+    """
+    options = notebook['metadata'].get('hugo-jupyter', {})
+    preprocessors = [CustomPreprocessor]
+    if options.get('bundle-scripts', True):
+        preprocessors.append(ScriptBundlePreprocessor)
+
+    c = Config()
+    if options.get('images'):
+        preprocessors.append(ImagePreprocessor)
+        if isinstance(options['images'], Mapping):
+            c.ImagePreprocessor.update(options['images'])
+    if options.get('highlight'):
+        preprocessors.append(HighlightPreprocessor)
+        if isinstance(options['highlight'], Mapping):
+            c.HighlightPreprocessor.update(options['highlight'])
+    c.HugoMarkdownExporter.preprocessors = preprocessors
+    c.HugoMarkdownExporter.validate_preprocessors = validation == 'full'
+    markdown_exporter = HugoMarkdownExporter(config=c)
+
+    markdown, _ = markdown_exporter.from_notebook_node(notebook)
+    return doctor(markdown)
+
+
+def cells_hash(notebook: nbformat.NotebookNode) -> str:
+    """
+    Return a hash of everything that affects a notebook's rendered body.
+
+    That is its cells, the language they're highlighted as, and its hugo-jupyter settings, but not its front matter.
+    """
+    language = notebook['metadata'].get('language_info', {}).get('name')
+    options = notebook['metadata'].get('hugo-jupyter', {})
+    content = json.dumps([language, options, notebook['cells']], sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class MarkdownCache:
+    """
+    Cache of rendered markdown bodies, keyed by notebook path and the hash of the notebook's cells.
+
+    A notebook whose cells haven't changed since it was last rendered (e.g. only its
+    front matter was edited) reuses its cached body instead of going through nbconvert again.
+    """
+
+    def __init__(self):
+        # a mapping of notebook filepaths to the (cells hash, markdown body) they were last rendered as
+        self.bodies: Dict[str, Tuple[str, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def body(self, path: Union[Path, str], notebook: nbformat.NotebookNode, render: Callable = None) -> str:
+        """
+        Return the notebook's rendered markdown body, rendering it only if its cells changed.
+
+        Args:
+            path: path to the notebook
+            notebook: the notebook node
+            render: what renders the body, `markdown_body` by default
+        """
+        key = cells_hash(notebook)
+        cached_key, cached_body = self.bodies.get(str(path), (None, None))
+        if cached_key == key:
+            self.hits += 1
+            METRICS.inc('hugo_jupyter_body_cache_hits_total')
+            return cached_body
+        self.misses += 1
+        METRICS.inc('hugo_jupyter_body_cache_misses_total')
+        body = (render or markdown_body)(notebook)
+        self.bodies[str(path)] = (key, body)
+        return body
+
+
+VALIDATION_POLICIES = ('full', 'cached', 'skip')
+
+
+def validation_hash(notebook: nbformat.NotebookNode) -> str:
+    """
+    Return a hash of everything in a notebook that's validated, except its front matter.
+
+    Front matter is free-form metadata that can't make a notebook invalid, so
+    front-matter-only edits don't need the cells validated again.
+    """
+    metadata = {key: value for key, value in notebook['metadata'].items() if key != 'front-matter'}
+    content = json.dumps([cells_hash(notebook), metadata, notebook['nbformat'], notebook['nbformat_minor']],
+                         sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class NotebookValidations:
+    """
+    Persistent record of notebooks' json schema validation, keyed by `validation_hash`.
+
+    Lets a notebook that hasn't changed since it was last validated skip validation,
+    and collects validation errors so they can be reported together.
+    """
+
+    def __init__(self, validations_file: Union[Path, str] = VALIDATIONS_FILE):
+        self.validations_file = Path(validations_file)
+        # a mapping of notebook filepaths to {'hash': validation hash, 'error': validation error or None}
+        self.records: Dict[str, dict] = (json.loads(self.validations_file.read_text())
+                                         if self.validations_file.exists() else {})
+
+    def validate(self, path: Union[Path, str], notebook: nbformat.NotebookNode, policy: str) -> Optional[str]:
+        """
+        Validate a notebook according to the policy.
+
+        Args:
+            path: path to the notebook
+            notebook: the notebook node read from it
+            policy: 'full' always validates, 'cached' only validates cells and metadata that weren't
+                    validated before, and 'skip' never validates
+
+        Returns: the validation error, if any
+        """
+        assert policy in VALIDATION_POLICIES, 'validation must be one of {}'.format(', '.join(VALIDATION_POLICIES))
+        if policy == 'skip':
+            return None
+
+        name = Path(path).as_posix()
+        digest = validation_hash(notebook)
+        record = self.records.get(name, {})
+        if policy == 'cached' and record.get('hash') == digest:
+            METRICS.inc('hugo_jupyter_validation_cache_hits_total')
+            return record['error']
+
+        try:
+            nbformat.validate(notebook)
+            error = None
+        except nbformat.ValidationError as e:
+            error = getattr(e, 'message', str(e))
+        self.records[name] = {'hash': digest, 'error': error}
+        self.save()
+        return error
+
+    def record_unreadable(self, path: Union[Path, str], error: Exception):
+        """Record that a notebook couldn't be read, so it's reported as invalid until it can be."""
+        self.records[Path(path).as_posix()] = {'hash': None, 'error': '{}: {}'.format(type(error).__name__, error)}
+        self.save()
+
+    def save(self):
+        self.validations_file.parent.mkdir(parents=True, exist_ok=True)
+        self.validations_file.write_text(json.dumps(self.records, indent=2, sort_keys=True))
+
+    def errors(self, notebooks: Iterable[Path]) -> Dict[str, str]:
+        """Return the validation errors of the notebooks, by notebook filepath."""
+        return {name: record['error'] for name, record in sorted(self.records.items())
+                if record['error'] and name in {notebook.as_posix() for notebook in notebooks}}
+
+    def report(self, notebooks: Iterable[Path]) -> Dict[str, str]:
+        """Print the validation errors of the notebooks and return them."""
+        errors = self.errors(notebooks)
+        for name, error in errors.items():
+            print(crayons.yellow('{} is not a valid notebook: {}'.format(name, error)))
+        if errors:
+            print(crayons.yellow('{} notebook(s) failed validation'.format(len(errors))))
+        return errors
+
+
+def load_notebook(path: Union[Path, str], validation: str = 'cached') -> nbformat.NotebookNode:
+    """
+    Read a notebook as nbformat 4, validating it according to the validation policy.
+
+    Unlike `nbformat.read`, which validates every notebook on every read, a notebook is
+    only validated again if its cells or non-front-matter metadata changed since it was
+    last validated, unless the policy is 'full'. Validation errors are recorded rather than raised, as nbformat does.
+
+    Args:
+        path: path to the notebook
+        validation: 'full', 'cached' or 'skip' (see `NotebookValidations.validate`)
+    """
+    notebook = nbformat.convert(nbformat.reader.reads(Path(path).read_text()), 4)
+    error = NotebookValidations().validate(path, notebook, validation)
+    if error:
+        print(crayons.yellow('{} is not a valid notebook: {}'.format(path, error.splitlines()[0])))
+    return notebook
+
+
+def notebook_to_markdown(path: Union[Path, str],
+                         cache: Optional[MarkdownCache] = None,
+                         limits: Optional['RenderLimits'] = None,
+                         validation: str = 'cached') -> str:
     """
     Convert jupyter notebook to hugo-formatted markdown string
 
     Args:
         path: path to notebook
+        cache: reuse the markdown body rendered for unchanged cells
+        limits: render the body in a worker process with these limits
+        validation: validation policy for reading the notebook (see `load_notebook`)
 
     Returns: hugo-formatted markdown
 
     """
     # first, update the notebook's metadata
-    update_notebook_metadata(path)
+    with METRICS.time('metadata'):
+        update_notebook_metadata(path)
 
-    with open(Path(path)) as fp:
-        notebook = nbformat.read(fp, as_version=4)
+    with METRICS.time('read'):
+        notebook = load_notebook(path, validation)
         assert 'front-matter' in notebook['metadata'], "You must have a front-matter field in the notebook's metadata"
-        front_matter_dict = dict(notebook['metadata']['front-matter'])
-        front_matter = json.dumps(front_matter_dict, indent=2)
+        header = front_matter_header(notebook['metadata'])
 
-    c = Config()
-    c.MarkdownExporter.preprocessors = [CustomPreprocessor]
-    markdown_exporter = MarkdownExporter(config=c)
-
-    markdown, _ = markdown_exporter.from_notebook_node(notebook)
-    doctored_md = doctor(markdown)
     # added <!--more--> comment to prevent summary creation
-    output = '\n'.join(('---', front_matter, '---', '<!--more-->', doctored_md))
+    render = partial(markdown_body, validation=validation)
+    if limits is not None:
+        render = partial(limits.run, render)
+    with METRICS.time('body'):
+        body = cache.body(path, notebook, render) if cache is not None else render(notebook)
+    output = '\n'.join((header, '<!--more-->', body))
 
     return output
 
 
-def write_hugo_formatted_nb_to_md(notebook: Union[Path, str], render_to: Optional[Union[Path, str]] = None) -> Path:
+def rendered_markdown_path(notebook_metadata: Mapping[str, Any], render_to: Optional[Union[Path, str]] = None) -> Path:
+    """
+    Return the path of the markdown file a notebook is rendered to.
+
+    Args:
+        notebook_metadata: the notebook's metadata
+        render_to: The directory we want to render the notebook to, overriding the notebook's render-to field
+    """
+    slug = notebook_metadata['front-matter']['slug']
+    render_to = render_to or notebook_metadata.get('hugo-jupyter', {}).get('render-to') or 'content/post/'
+    return Path(render_to, slug + '.md')
+
+
+def write_hugo_formatted_nb_to_md(notebook: Union[Path, str],
+                                  render_to: Optional[Union[Path, str]] = None,
+                                  cache: Optional[MarkdownCache] = None,
+                                  limits: Optional['RenderLimits'] = None,
+                                  validation: str = 'cached') -> Path:
     """
     Convert Jupyter notebook to markdown and write it to the appropriate file.
 
     Args:
         notebook: The path to the notebook to be rendered
         render_to: The directory we want to render the notebook to
+        cache: reuse the markdown body rendered for unchanged cells
+        limits: render the body in a worker process with these limits
+        validation: validation policy for reading the notebook (see `load_notebook`)
     """
     notebook = Path(notebook)
-    notebook_metadata = json.loads(notebook.read_text())['metadata']
-    rendered_markdown_string = notebook_to_markdown(notebook)
-    slug = notebook_metadata['front-matter']['slug']
-    render_to = render_to or notebook_metadata['hugo-jupyter']['render-to'] or 'content/post/'
+    rendered_markdown_string = notebook_to_markdown(notebook, cache=cache, limits=limits, validation=validation)
+    notebook_metadata = read_notebook_metadata(notebook)
+    rendered_markdown_file = rendered_markdown_path(notebook_metadata, render_to)
+
+    with METRICS.time('write'):
+        written = write_if_changed(rendered_markdown_file, rendered_markdown_string)
+    if written:
+        print(notebook.name, '->', rendered_markdown_file.name)
+    else:
+        print(notebook.name, '->', rendered_markdown_file.name, '(unchanged)')
+    return rendered_markdown_file
 
-    if not render_to.endswith('/'):
-        render_to += '/'
 
-    rendered_markdown_file = Path(render_to, slug + '.md')
+def write_if_changed(path: Path, text: str) -> bool:
+    """
+    Write text to path unless the file already has exactly that content.
 
-    if not rendered_markdown_file.parent.exists():
-        rendered_markdown_file.parent.mkdir(parents=True)
+    Leaving unchanged files alone keeps their mtime, so hugo doesn't rebuild pages that didn't change.
 
-    rendered_markdown_file.write_text(rendered_markdown_string)
-    print(notebook.name, '->', rendered_markdown_file.name)
-    return rendered_markdown_file
+    Returns: True if the file was written
+    """
+    if path.exists() and path.read_text() == text:
+        return False
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    path.write_text(text)
+    METRICS.inc('hugo_jupyter_bytes_written_total', len(text.encode()))
+    return True
+
+
+# what may follow the notebook-level metadata when keys are in nbformat's (sorted) order
+NOTEBOOK_TAIL = re.compile(r'\s*(,\s*"nbformat(_minor)?"\s*:\s*\d+\s*)*}\s*$')
+
+# how much of the end of a notebook is read at first when looking for its metadata
+METADATA_WINDOW = 64 * 1024
+
+
+def locate_notebook_metadata(notebook: Union[Path, str]) -> Optional[Tuple[int, int, dict]]:
+    """
+    Find the notebook-level metadata by reading only the end of the file.
+
+    nbformat writes the notebook's keys in sorted order, so the metadata comes after all
+    the cells and their outputs. This reads a window from the end of the file, growing it
+    until it holds the metadata, and never parses any cell.
+
+    Returns: (start, end, metadata) where start and end are the byte offsets of the
+    metadata's json value, or None if the metadata isn't the last object in the notebook
+    """
+    decoder = json.JSONDecoder()
+    with open(str(notebook), 'rb') as fp:
+        size = fp.seek(0, 2)
+        window = METADATA_WINDOW
+        while True:
+            offset = max(size - window, 0)
+            fp.seek(offset)
+            data = fp.read()
+            position = len(data)
+            while True:
+                position = data.rfind(b'"metadata"', 0, position)
+                if position == -1:
+                    break
+                if not data[:position].rstrip().endswith((b',', b'{')):
+                    continue
+                text = data[position + len(b'"metadata"'):].decode('utf-8')
+                colon = len(text) - len(text.lstrip())
+                if not text[colon:].startswith(':'):
+                    continue
+                value_start = len(text) - len(text[colon + 1:].lstrip())
+                try:
+                    metadata, value_end = decoder.raw_decode(text, value_start)
+                except ValueError:
+                    continue
+                if isinstance(metadata, dict) and NOTEBOOK_TAIL.match(text, value_end):
+                    start = offset + position + len(b'"metadata"') + len(text[:value_start].encode('utf-8'))
+                    end = start + len(text[value_start:value_end].encode('utf-8'))
+                    return start, end, metadata
+            if offset == 0:
+                return None
+            window *= 4
+
+
+def read_notebook_metadata(notebook: Union[Path, str]) -> dict:
+    """
+    Return a notebook's metadata without parsing its cells.
+
+    Falls back to parsing the whole notebook if its metadata can't be found at the end of the file.
+    """
+    located = locate_notebook_metadata(notebook)
+    if located is not None:
+        return located[2]
+    return json.loads(Path(notebook).read_text()).get('metadata', {})
+
+
+def write_notebook_metadata(notebook: Union[Path, str], metadata: Mapping[str, Any]):
+    """
+    Replace a notebook's metadata, splicing it into the file without re-serializing the cells.
+
+    Only the bytes from the metadata onwards are re-written.
+    Falls back to re-writing the whole notebook if its metadata can't be found at the end of the file.
+    """
+    located = locate_notebook_metadata(notebook)
+    if located is None:
+        notebook_data = json.loads(Path(notebook).read_text())
+        notebook_data['metadata'] = metadata
+        Path(notebook).write_text(json.dumps(notebook_data))
+        return
+
+    start, end, _ = located
+    with open(str(notebook), 'r+b') as fp:
+        fp.seek(end)
+        tail = fp.read()
+        fp.seek(start)
+        fp.write(json.dumps(metadata, indent=1, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        fp.write(tail)
+        fp.truncate()
+
+
+def default_front_matter(notebook_path: Path, front_matter: Mapping[str, Any]) -> dict:
+    """
+    Return the front matter with the fields hugo-jupyter requires filled in.
+
+    Any other keys in the front matter are passed through untouched.
+
+    Args:
+        notebook_path: the notebook the front matter belongs to
+        front_matter: the notebook's existing front matter
+    """
+    title = front_matter.get('title') or notebook_path.stem
+    required = {
+        'title': title,
+        'subtitle': front_matter.get('subtitle') or 'Generic subtitle',
+        'date': front_matter.get('date') or datetime.now().strftime('%Y-%m-%d'),
+        'slug': front_matter.get('slug') or title.lower().replace(' ', '-'),
+    }
+    return {**required, **{k: v for k, v in front_matter.items() if k not in required}}
+
+
+def trust_notebooks(notebooks: Iterable[Union[Path, str]]):
+    """Make the notebooks trusted again with a single call to `jupyter trust`."""
+    notebooks = [str(notebook) for notebook in notebooks]
+    if notebooks:
+        sp.run(['jupyter', 'trust', *notebooks])
 
 
 def update_notebook_metadata(notebook: Union[Path, str],
@@ -223,47 +1123,914 @@ def update_notebook_metadata(notebook: Union[Path, str],
                              subtitle: Union[None, str] = None,
                              date: Union[None, str] = None,
                              slug: Union[None, str] = None,
-                             render_to: str = None) -> Path:
+                             render_to: str = None,
+                             trust: bool = True) -> Path:
     """
     Update the notebook's metadata for hugo rendering
 
+    The notebook is only re-written (and re-trusted) if its metadata actually changed.
+
     Args:
         notebook: notebook to have edited
+        trust: run `jupyter trust` on the notebook if it was re-written
     """
     notebook_path: Path = Path(notebook)
-    notebook_data: dict = json.loads(notebook_path.read_text())
-    old_front_matter: dict = notebook_data.get('metadata', {}).get('front-matter', {})
+    metadata: dict = read_notebook_metadata(notebook_path)
+    old_metadata: dict = json.loads(json.dumps(metadata))
 
     # generate front-matter fields
-    title = title or old_front_matter.get('title') or notebook_path.stem
-    subtitle = subtitle or old_front_matter.get('subtitle') or 'Generic subtitle'
-    date = date or old_front_matter.get('date') or datetime.now().strftime('%Y-%m-%d')
-    slug = slug or old_front_matter.get('slug') or title.lower().replace(' ', '-')
+    overrides = {'title': title, 'subtitle': subtitle, 'date': date, 'slug': slug}
+    front_matter = dict(metadata.get('front-matter', {}))
+    front_matter.update((key, value) for key, value in overrides.items() if value)
+    metadata['front-matter'] = default_front_matter(notebook_path, front_matter)
 
-    front_matter = {
-        'title': title,
-        'subtitle': subtitle,
-        'date': date,
-        'slug': slug,
-    }
+    # update hugo-jupyter settings
+    hugo_jupyter = dict(metadata.get('hugo-jupyter', {}))
+    hugo_jupyter['render-to'] = render_to or hugo_jupyter.get('render-to') or 'content/post/'
+    metadata['hugo-jupyter'] = hugo_jupyter
 
-    # update front-matter
-    notebook_data['metadata']['front-matter'] = front_matter
+    if metadata != old_metadata:
+        # write the new front-matter over the old
+        write_notebook_metadata(notebook_path, metadata)
 
-    # update hugo-jupyter settings
-    render_to = render_to or notebook_data['metadata'].get('hugo-jupyter', {}).get('render-to') or 'content/post/'
-    hugo_jupyter = {
-        'render-to': render_to
+        # make the notebook trusted again, now that we've changed it
+        if trust:
+            trust_notebooks([notebook_path])
+
+    return notebook_path
+
+
+########## Front matter stuff #################
+
+# front matter fields hugo expects to be lists, given as semicolon-separated strings on the command line
+LIST_FRONT_MATTER_KEYS = {'tags', 'categories', 'keywords', 'aliases', 'series'}
+
+
+def coerce_front_matter_value(key: str, value: Any) -> Any:
+    """
+    Convert a front matter value given as a string to the type hugo expects.
+
+    List fields (tags, categories, ...) are split on semicolons and
+    'true'/'false' become booleans. Dates and times, e.g. native toml dates,
+    become iso 8601 strings so they can be stored in the notebook's json metadata.
+    Other values are returned as-is.
+    """
+    if not isinstance(value, str):
+        return json_front_matter_value(value)
+    value = value.strip()
+    if key in LIST_FRONT_MATTER_KEYS:
+        return [item.strip() for item in value.split(';') if item.strip()]
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    return value
+
+
+def json_front_matter_value(value: Any) -> Any:
+    """Return the value with any dates and times in it replaced by iso 8601 strings."""
+    if isinstance(value, (date_type, time_type)):
+        return value.isoformat()
+    if isinstance(value, list):
+        return [json_front_matter_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: json_front_matter_value(item) for key, item in value.items()}
+    return value
+
+
+def apply_front_matter_changes(front_matter: Mapping[str, Any], changes: Mapping[str, Any]) -> dict:
+    """
+    Return a copy of the front matter with the changes applied.
+
+    A change whose value is None or an empty string removes that key.
+    """
+    updated = dict(front_matter)
+    for key, value in changes.items():
+        if value is None or value == '':
+            updated.pop(key, None)
+        else:
+            updated[key] = coerce_front_matter_value(key, value)
+    return updated
+
+
+def is_renderable(notebook: Union[Path, str]) -> bool:
+    """Return True if the notebook is neither untitled nor hidden (e.g. in .ipynb_checkpoints)."""
+    notebook = Path(notebook)
+    return 'untitled' not in notebook.name.lower() and not any(part.startswith('.') for part in notebook.parts)
+
+
+def find_notebooks(pattern: Union[Path, str]) -> List[Path]:
+    """
+    Return the renderable notebooks matching a glob pattern, file, or directory (searched recursively).
+    """
+    path = Path(pattern)
+    if path.is_dir():
+        matches = path.glob('**/*.ipynb')
+    elif path.exists():
+        matches = [path]
+    else:
+        matches = Path().glob(str(pattern))
+    return sorted(match for match in matches if match.suffix == '.ipynb' and is_renderable(match))
+
+
+def toml_loads() -> Optional[Callable[[str], dict]]:
+    """Return the `loads` of tomllib (python 3.11+) or of the toml package, whichever is available."""
+    try:
+        import tomllib
+        return tomllib.loads
+    except ImportError:
+        pass
+    try:
+        import toml
+        return toml.loads
+    except ImportError:
+        return None
+
+
+def load_toml(text: str) -> dict:
+    """Parse a toml document with tomllib (python 3.11+) or the toml package."""
+    loads = toml_loads()
+    if loads is None:
+        abort('Reading toml requires python 3.11+ or the toml package: pip install toml')
+    return loads(text)
+
+
+def read_front_matter_manifest(manifest: Union[Path, str]) -> List[Tuple[str, dict]]:
+    """
+    Read a manifest of front matter changes.
+
+    A toml manifest maps notebook glob patterns to tables of changes::
+
+        ["notebooks/drafts/*.ipynb"]
+        draft = true
+        tags = ["python", "hugo"]
+
+    A csv manifest has a `notebook` column holding the glob pattern and one
+    column per front matter key; empty cells leave that key unchanged.
+
+    Returns: [(pattern, changes), ...] in manifest order
+    """
+    manifest = Path(manifest)
+    if manifest.suffix == '.toml':
+        return [(pattern, dict(changes)) for pattern, changes in load_toml(manifest.read_text()).items()]
+    with manifest.open(newline='') as fp:
+        return [(row.pop('notebook'), {key: value for key, value in row.items() if value})
+                for row in csv.DictReader(fp)]
+
+
+FRONT_MATTER_DELIMITERS = {
+    'json': '---',  # json is valid yaml, so hugo reads it between yaml delimiters
+    'yaml': '---',
+    'toml': '+++',
+}
+
+BARE_KEY = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def site_front_matter_format(config: Union[Path, str] = 'config.toml') -> Optional[str]:
+    """
+    Return the site's top-level `metaDataFormat` setting from its hugo config, if any.
+
+    The config is only parsed again once it's modified.
+    """
+    config = Path(config)
+    if not config.exists():
+        return None
+    return _site_front_matter_format(config, config.stat().st_mtime)
+
+
+@lru_cache(maxsize=16)
+def _site_front_matter_format(config: Path, mtime: float) -> Optional[str]:
+    if toml_loads() is None:
+        print(crayons.yellow("can't read {} without python 3.11+ or the toml package; "
+                             "front matter defaults to json".format(config)))
+        return None
+    fmt = load_toml(config.read_text()).get('metaDataFormat')
+    return fmt.lower() if isinstance(fmt, str) else None
+
+
+def front_matter_format(notebook_metadata: Mapping[str, Any]) -> str:
+    """
+    Return the front matter format (json, yaml, or toml) a notebook should be rendered with.
+
+    The notebook's hugo-jupyter.front-matter-format field takes precedence over the
+    site's `metaDataFormat`, falling back to json.
+    """
+    fmt = (notebook_metadata.get('hugo-jupyter', {}).get('front-matter-format')
+           or site_front_matter_format()
+           or 'json').lower()
+    assert fmt in FRONT_MATTER_DELIMITERS, 'front matter format must be one of {}'.format(
+        ', '.join(FRONT_MATTER_DELIMITERS))
+    return fmt
+
+
+def toml_key(key: str) -> str:
+    return key if BARE_KEY.match(key) else json.dumps(key, ensure_ascii=False)
+
+
+def toml_value(value: Any) -> str:
+    """Serialize a value as an inline toml value."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, Mapping):
+        return '{' + ', '.join('{} = {}'.format(toml_key(k), toml_value(v))
+                               for k, v in value.items() if v is not None) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(toml_value(item) for item in value) + ']'
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+def to_toml(front_matter: Mapping[str, Any], table: str = '') -> str:
+    """Serialize front matter as toml; nested mappings become tables and None values are dropped."""
+    lines, tables = [], []
+    for key, value in front_matter.items():
+        if isinstance(value, Mapping):
+            tables.append((key, value))
+        elif value is not None:
+            lines.append('{} = {}'.format(toml_key(key), toml_value(value)))
+    for key, value in tables:
+        name = '.'.join(filter(None, (table, toml_key(key))))
+        lines.extend(('', '[{}]'.format(name), to_toml(value, name)))
+    return '\n'.join(lines)
+
+
+def to_yaml(front_matter: Mapping[str, Any], indent: int = 0) -> str:
+    """Serialize front matter as yaml; nested mappings become blocks and other values json (flow) style."""
+    lines = []
+    for key, value in front_matter.items():
+        key = key if BARE_KEY.match(str(key)) else json.dumps(str(key), ensure_ascii=False)
+        if isinstance(value, Mapping) and value:
+            lines.append('{}{}:'.format(' ' * indent, key))
+            lines.append(to_yaml(value, indent + 2))
+        else:
+            lines.append('{}{}: {}'.format(' ' * indent, key, json.dumps(value, ensure_ascii=False, default=str)))
+    return '\n'.join(lines)
+
+
+@lru_cache(maxsize=1024)
+def _serialize_front_matter(front_matter_json: str, fmt: str) -> str:
+    front_matter = json.loads(front_matter_json, object_pairs_hook=OrderedDict)
+    if fmt == 'toml':
+        serialized = to_toml(front_matter)
+    elif fmt == 'yaml':
+        serialized = to_yaml(front_matter)
+    else:
+        serialized = json.dumps(front_matter, indent=2)
+    delimiter = FRONT_MATTER_DELIMITERS[fmt]
+    return '\n'.join((delimiter, serialized, delimiter))
+
+
+def front_matter_header(notebook_metadata: Mapping[str, Any]) -> str:
+    """
+    Return the delimited front matter block for a notebook's metadata.
+
+    Serialization is cached on the front matter's content, so unchanged front matter is never re-serialized.
+    """
+    front_matter_json = json.dumps(notebook_metadata['front-matter'], default=str)
+    return _serialize_front_matter(front_matter_json, front_matter_format(notebook_metadata))
+
+
+def split_front_matter(markdown: str) -> Tuple[str, str]:
+    """
+    Split rendered markdown into its front matter block and the rest of the document.
+
+    Returns: (header, body) where body starts with the newline following the closing delimiter
+    """
+    delimiter = markdown.split('\n', 1)[0]
+    assert delimiter in FRONT_MATTER_DELIMITERS.values(), 'markdown does not start with front matter'
+    end = markdown.index('\n' + delimiter, len(delimiter)) + len(delimiter) + 1
+    return markdown[:end], markdown[end:]
+
+
+def patch_front_matter(markdown_file: Path, header: str) -> bool:
+    """
+    Replace the front matter of an already-rendered markdown file, leaving its body untouched.
+
+    Returns: True if the file was changed
+    """
+    _, body = split_front_matter(markdown_file.read_text())
+    return write_if_changed(markdown_file, header + body)
+
+
+def patch_rendered_front_matter(notebook: Path, old_metadata: Mapping[str, Any], new_metadata: Mapping[str, Any]) -> Optional[Path]:
+    """
+    Bring an already-rendered post's front matter up to date without re-running nbconvert.
+
+    If the slug changed, the post is moved to its new file name.
+
+    Returns: the patched markdown file, or None if the notebook hasn't been rendered yet
+    """
+    old_file = rendered_markdown_path(old_metadata) if old_metadata.get('front-matter', {}).get('slug') else None
+    if old_file is None or not old_file.exists():
+        return None
+    new_file = rendered_markdown_path(new_metadata)
+    if new_file != old_file:
+        new_file.parent.mkdir(parents=True, exist_ok=True)
+        old_file.rename(new_file)
+    patch_front_matter(new_file, front_matter_header(new_metadata))
+    print(notebook.name, '->', new_file.name, '(front matter)')
+    return new_file
+
+
+def plan_front_matter_update(notebook: Path,
+                             changes: Mapping[str, Any],
+                             dry_run: bool = False,
+                             patch_rendered: bool = True,
+                             written: Optional[List[Path]] = None) -> Tuple[dict, dict]:
+    """
+    Apply front matter changes to a notebook, writing it back if anything changed.
+
+    Trusting the notebook is left to the caller so it can be batched.
+
+    Args:
+        notebook: the notebook to change
+        changes: front matter changes (see `apply_front_matter_changes`)
+        dry_run: compute the changes without writing anything
+        patch_rendered: also patch the header of the notebook's already-rendered post
+        written: the notebook is appended to this list as soon as it's written,
+                 so the caller can trust it even if patching its post fails
+
+    Returns: (old front matter, new front matter)
+    """
+    metadata = read_notebook_metadata(notebook)
+    old_metadata = dict(metadata)
+    old_front_matter = metadata.get('front-matter', {})
+    new_front_matter = default_front_matter(notebook, apply_front_matter_changes(old_front_matter, changes))
+
+    if new_front_matter != old_front_matter and not dry_run:
+        metadata['front-matter'] = new_front_matter
+        write_notebook_metadata(notebook, metadata)
+        if written is not None:
+            written.append(notebook)
+        if patch_rendered:
+            patch_rendered_front_matter(notebook, old_metadata, metadata)
+
+    return old_front_matter, new_front_matter
+
+
+def front_matter_diff(notebook: Path, old: dict, new: dict) -> str:
+    """Return a unified diff between two versions of a notebook's front matter."""
+    return ''.join(difflib.unified_diff(
+        (json.dumps(old, indent=2, sort_keys=True) + '\n').splitlines(True),
+        (json.dumps(new, indent=2, sort_keys=True) + '\n').splitlines(True),
+        fromfile='{} (old)'.format(notebook),
+        tofile='{} (new)'.format(notebook),
+    ))
+
+
+########## Resource limits stuff #################
+
+class RenderFailure(Exception):
+    """A notebook failed to render in a worker process."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__('{}: {}'.format(kind, message))
+        # one of 'timeout', 'memory', 'crash', or 'error'
+        self.kind = kind
+        self.message = message
+
+
+def _run_limited(connection, memory_limit: int, function: Callable, args: tuple):
+    """Run a function in a worker process under a memory limit, sending its result back over the connection."""
+    try:
+        if memory_limit:
+            limit = memory_limit * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        connection.send((None, function(*args)))
+    except MemoryError:
+        connection.send((('memory', 'exceeded the memory limit of {} MB'.format(memory_limit)), None))
+    except BaseException:
+        connection.send((('error', traceback.format_exc()), None))
+    finally:
+        connection.close()
+
+
+class RenderLimits:
+    """
+    Wall-clock time and memory limits for rendering a notebook.
+
+    Work is run in a forked worker process whose address space is capped with rlimit, and
+    which is killed if it runs past the timeout. Where processes can't be forked or rlimits
+    set (i.e. windows), work runs in-process without limits.
+    """
+
+    def __init__(self, timeout: float = RENDER_TIMEOUT, memory_limit: int = RENDER_MEMORY_LIMIT):
+        """
+        Args:
+            timeout: seconds the work may take; 0 for no limit
+            memory_limit: megabytes the worker may use; 0 for no limit
+        """
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+
+    def run(self, function: Callable, *args):
+        """
+        Call the function with args in a worker process and return its result.
+
+        Raises: RenderFailure if it times out, runs out of memory, crashes, or raises
+        """
+        if resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+            return function(*args)
+
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        worker = context.Process(target=_run_limited, args=(sender, self.memory_limit, function, args))
+        worker.start()
+        sender.close()
+        try:
+            if not receiver.poll(self.timeout or None):
+                # Process.kill only exists from python 3.7
+                os.kill(worker.pid, signal.SIGKILL)
+                raise RenderFailure('timeout', 'took longer than {:g} seconds'.format(self.timeout))
+            try:
+                failure, result = receiver.recv()
+            except EOFError:
+                worker.join()
+                raise RenderFailure('crash', 'worker exited with code {}'.format(worker.exitcode))
+        finally:
+            receiver.close()
+            worker.join()
+
+        if failure is not None:
+            raise RenderFailure(*failure)
+        return result
+
+
+class RenderFailures:
+    """
+    Persistent record of notebooks that failed to render.
+
+    A notebook is quarantined once it has failed `quarantine_after` times in a row, and
+    stays quarantined until it is rendered successfully or cleared. The file is re-read
+    whenever another process changes it, e.g. `fab clear_quarantine` while `serve` runs.
+    """
+
+    def __init__(self, failures_file: Union[Path, str] = FAILURES_FILE, quarantine_after: int = QUARANTINE_AFTER):
+        self.failures_file = Path(failures_file)
+        self.quarantine_after = quarantine_after
+        # a mapping of notebook filepaths to their latest failure
+        self.records: Dict[str, dict] = {}
+        # the (mtime, size) of the failures file when the records were last read or written
+        self.file_stamp: Optional[Tuple[int, int]] = None
+        self.reload()
+
+    def stamp(self) -> Optional[Tuple[int, int]]:
+        if not self.failures_file.exists():
+            return None
+        stat = self.failures_file.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        """Re-read the records if the failures file changed since they were last read or written."""
+        stamp = self.stamp()
+        if stamp != self.file_stamp:
+            self.records = json.loads(self.failures_file.read_text()) if stamp is not None else {}
+            self.file_stamp = stamp
+
+    def record(self, notebook: Union[Path, str], error: Exception):
+        """Record that a notebook failed to render."""
+        self.reload()
+        name = Path(notebook).as_posix()
+        failures = self.records.get(name, {}).get('failures', 0) + 1
+        self.records[name] = {
+            'kind': getattr(error, 'kind', 'error'),
+            'message': getattr(error, 'message', '{}: {}'.format(type(error).__name__, error)),
+            'failures': failures,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'quarantined': failures >= self.quarantine_after,
+        }
+        print(crayons.red('{} failed to render ({})'.format(name, self.records[name]['kind'])))
+        if self.records[name]['quarantined']:
+            print(crayons.red('{} failed {} times in a row and is quarantined'.format(name, failures)))
+        self.save()
+
+    def clear(self, notebook: Union[Path, str]):
+        """Forget a notebook's failures, e.g. because it rendered successfully."""
+        self.reload()
+        if self.records.pop(Path(notebook).as_posix(), None) is not None:
+            self.save()
+
+    def is_quarantined(self, notebook: Union[Path, str]) -> bool:
+        self.reload()
+        return self.records.get(Path(notebook).as_posix(), {}).get('quarantined', False)
+
+    def save(self):
+        self.failures_file.parent.mkdir(parents=True, exist_ok=True)
+        self.failures_file.write_text(json.dumps(self.records, indent=2, sort_keys=True))
+        self.file_stamp = self.stamp()
+
+    def report(self, notebooks: Iterable[Path]):
+        """Print the failures among the notebooks and abort if there were any."""
+        failed = {name: record for name, record in sorted(self.records.items())
+                  if name in {notebook.as_posix() for notebook in notebooks}}
+        if not failed:
+            return
+        for name, record in failed.items():
+            print(crayons.red('{} {} (failed {} time(s){})'.format(
+                name, record['kind'], record['failures'], ', quarantined' if record['quarantined'] else '')))
+            print(record['message'].rstrip())
+        abort('{} notebook(s) failed to render; see {}'.format(len(failed), self.failures_file))
+
+
+########## Rendering stuff #################
+
+def notebooks_to_render(notebooks_dir: Union[Path, str] = 'notebooks') -> List[Path]:
+    """Return the notebooks `render_notebooks` renders, in a stable order."""
+    return sorted(notebook for notebook in Path(notebooks_dir).glob('*.ipynb') if is_renderable(notebook))
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parse a shard given as `i/N` into (i, N), where i counts from 1."""
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', str(shard))
+    assert match, 'shard must be given as i/N, e.g. 1/4'
+    index, count = int(match.group(1)), int(match.group(2))
+    assert 1 <= index <= count, 'shard index must be between 1 and {}'.format(count)
+    return index, count
+
+
+def load_render_times() -> Dict[str, float]:
+    """Return how long each notebook took to render, in seconds, the last time it was rendered."""
+    if RENDER_TIMES_FILE.exists():
+        return json.loads(RENDER_TIMES_FILE.read_text())
+    return {}
+
+
+def record_render_times(times: Mapping[str, float]):
+    """Merge render times, in seconds, keyed by notebook path, into the render times file."""
+    if not times:
+        return
+    recorded = load_render_times()
+    recorded.update(times)
+    RENDER_TIMES_FILE.parent.mkdir(parents=True, exist_ok=True)
+    RENDER_TIMES_FILE.write_text(json.dumps(recorded, indent=2, sort_keys=True))
+
+
+def committed_sizes(notebooks: Iterable[Path]) -> Dict[Path, int]:
+    """Return the sizes, in bytes, of the notebooks as committed at HEAD; uncommitted notebooks are left out."""
+    notebooks = list(notebooks)
+    if not notebooks:
+        return {}
+    with settings(warn_only=True):
+        tree = local('git ls-tree -l HEAD -- {}'.format(' '.join(shlex.quote(notebook.as_posix())
+                                                                    for notebook in notebooks)), capture=True)
+    if tree.failed:
+        return {}
+    sizes = {}
+    for line in tree.splitlines():
+        info, path = line.split('\t', 1)
+        sizes[Path(path)] = int(info.split()[3])
+    return sizes
+
+
+def render_weights(notebooks: Iterable[Path]) -> Dict[Path, float]:
+    """
+    Estimate how long each notebook takes to render.
+
+    Notebooks with a recorded render time use it; the rest are estimated from their
+    size at the average seconds per byte of the recorded ones, or weighted by size
+    alone if nothing was recorded. Sizes are those committed at HEAD, since rendering
+    rewrites notebooks' metadata and would change the partition between shards.
+    """
+    recorded = load_render_times()
+    notebooks = list(notebooks)
+    committed = committed_sizes(notebooks)
+    sizes = {notebook: committed.get(notebook) or notebook.stat().st_size for notebook in notebooks}
+    known = {notebook: recorded[notebook.as_posix()] for notebook in sizes if notebook.as_posix() in recorded}
+    known_bytes = sum(sizes[notebook] for notebook in known)
+    seconds_per_byte = sum(known.values()) / known_bytes if known and known_bytes else 1.0
+    return {notebook: known.get(notebook, size * seconds_per_byte) for notebook, size in sizes.items()}
+
+
+def partition_notebooks(notebooks: Iterable[Path], count: int, weights: Mapping[Path, float]) -> List[List[Path]]:
+    """
+    Split notebooks into `count` shards of roughly equal total weight.
+
+    The heaviest notebooks are placed first, each into the currently lightest shard,
+    and ties are broken by path so every machine computes the same partition.
+    """
+    shards: List[List[Path]] = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for notebook in sorted(notebooks, key=lambda notebook: (-weights[notebook], notebook.as_posix())):
+        lightest = min(range(count), key=lambda index: (loads[index], index))
+        shards[lightest].append(notebook)
+        loads[lightest] += weights[notebook]
+    return shards
+
+
+def write_shard_manifest(index: int, count: int, rendered: Mapping[Path, Path], times: Mapping[str, float]) -> Path:
+    """Record which posts a shard rendered, for `merge_shards`."""
+    manifest = Path(SHARDS_DIR, '{}-of-{}.json'.format(index, count))
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+    manifest.write_text(json.dumps({
+        'shard': index,
+        'shards': count,
+        'rendered': {notebook.as_posix(): post.as_posix() for notebook, post in rendered.items()},
+        'times': dict(times),
+    }, indent=2, sort_keys=True))
+    return manifest
+
+
+def shard_errors(manifests: List[dict], notebooks: Iterable[Path]) -> List[str]:
+    """Return the problems with a set of shard manifests, if any."""
+    if not manifests:
+        return ['no shard manifests found']
+
+    errors = []
+    counts = {manifest['shards'] for manifest in manifests}
+    if len(counts) > 1:
+        errors.append('shards disagree on the number of shards: {}'.format(sorted(counts)))
+    missing_shards = set(range(1, max(counts) + 1)) - {manifest['shard'] for manifest in manifests}
+    errors.extend('shard {}/{} is missing'.format(index, max(counts)) for index in sorted(missing_shards))
+
+    rendered_by: Dict[str, List[int]] = defaultdict(list)
+    notebooks_by_post: Dict[str, List[str]] = defaultdict(list)
+    for manifest in manifests:
+        for notebook, post in manifest['rendered'].items():
+            rendered_by[notebook].append(manifest['shard'])
+            notebooks_by_post[post].append(notebook)
+
+    for notebook in sorted({notebook.as_posix() for notebook in notebooks} - set(rendered_by)):
+        errors.append('{} was not rendered by any shard'.format(notebook))
+    for notebook, shards in sorted(rendered_by.items()):
+        if len(shards) > 1:
+            errors.append('{} was rendered by shards {}'.format(notebook, shards))
+    for post, post_notebooks in sorted(notebooks_by_post.items()):
+        if len(set(post_notebooks)) > 1:
+            errors.append('{} were all rendered to {}'.format(', '.join(sorted(set(post_notebooks))), post))
+        if not Path(post).exists():
+            errors.append('{} is missing'.format(post))
+    return errors
+
+
+def last_published_commit() -> Optional[str]:
+    """Return the commit that was last published, or None if nothing was published from this repo yet."""
+    with settings(warn_only=True):
+        commit = local('git rev-parse --verify --quiet {}'.format(PUBLISHED_REF), capture=True)
+    return None if commit.failed else commit.strip()
+
+
+def changed_notebooks(since: str, notebooks_dir: Union[Path, str] = 'notebooks') -> Tuple[Set[Path], List[Path]]:
+    """
+    Ask git which notebooks changed between a ref and HEAD.
+
+    Returns: (notebooks added or modified since the ref, notebooks deleted or renamed away since the ref)
+    """
+    diff = local('git diff --name-status -M --relative {} HEAD -- {}'.format(since, notebooks_dir), capture=True)
+    changed, removed = set(), []
+    for line in diff.splitlines():
+        status, *paths = line.split('\t')
+        if status[0] in 'DR':
+            removed.append(Path(paths[0]))
+        if status[0] != 'D':
+            changed.add(Path(paths[-1]))
+    return changed, removed
+
+
+def post_at(since: str, notebook: Path) -> Optional[Path]:
+    """Return the post a notebook was rendered to at a ref, or None if it didn't exist or have a slug then."""
+    with settings(warn_only=True):
+        old_notebook = local('git show {}:./{}'.format(since, notebook.as_posix()), capture=True)
+    if old_notebook.failed:
+        return None
+    try:
+        return rendered_markdown_path(json.loads(old_notebook)['metadata'])
+    except (ValueError, KeyError):
+        return None
+
+
+def remove_stale_posts(since: str, removed: Iterable[Path], changed: Iterable[Path] = ()):
+    """
+    Remove the posts left behind by notebooks changed since a ref.
+
+    That is the posts that notebooks deleted or renamed since the ref were rendered to at
+    that ref, and those of changed notebooks whose slug or render-to field changed since.
+    """
+    stale = [post_at(since, notebook) for notebook in removed if notebook.suffix == '.ipynb']
+    for notebook in (notebook for notebook in changed if notebook.suffix == '.ipynb'):
+        old_post = post_at(since, notebook)
+        try:
+            moved = old_post is not None and old_post != rendered_markdown_path(read_notebook_metadata(notebook))
+        except KeyError:
+            # no slug yet; the notebook gets its default one when it's rendered
+            continue
+        if moved:
+            stale.append(old_post)
+
+    for post in stale:
+        if post is not None and post.exists():
+            post.unlink()
+            print(crayons.yellow('removed post: {}'.format(post)))
+
+
+########## Search index stuff #################
+
+# markdown links and images, whose text is searchable but whose targets aren't
+MARKDOWN_LINK = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+HTML_TAG = re.compile(r'<[^>]*>')
+
+
+def search_entry(notebook: Path) -> Optional[dict]:
+    """
+    Return a notebook's entry in the search index, or None if it's a draft, which hugo doesn't publish.
+
+    The summary is the front matter's summary or description, or else the beginning of its markdown
+    text. Cells that `CustomPreprocessor` drops from the post (e.g. tagged remove or hide) aren't indexed.
+    """
+    notebook_data = nbformat.convert(nbformat.reader.reads(notebook.read_text()), 4)
+    front_matter = notebook_data.get('metadata', {}).get('front-matter', {})
+    if str(front_matter.get('draft', False)).lower() == 'true':
+        return None
+    preprocessor = CustomPreprocessor()
+    markdown = '\n'.join(cell.source for cell in notebook_data.cells
+                         if cell.cell_type == 'markdown' and not preprocessor.is_removable(cell))
+    text = HTML_TAG.sub(' ', MARKDOWN_LINK.sub(r'\1', markdown))
+    summary = front_matter.get('summary') or front_matter.get('description') or shorten(text, 200, placeholder='...')
+    return {
+        'title': front_matter.get('title'),
+        'slug': front_matter.get('slug'),
+        'date': front_matter.get('date'),
+        'summary': summary,
+        'tokens': sorted({token for token in re.findall(r'\w+', text.lower()) if len(token) > 1}),
     }
-    notebook_data['metadata']['hugo-jupyter'] = hugo_jupyter
 
-    # write over old notebook with new front-matter
-    notebook_path.write_text(json.dumps(notebook_data))
 
-    # make the notebook trusted again, now that we've changed it
-    sp.run(['jupyter', 'trust', str(notebook_path)])
+class SearchIndex:
+    """
+    Client-side search index of the rendered notebooks, written as json to hugo's static directory.
 
-    return notebook_path
+    Entries are kept in a state file along with the mtime and size of the notebook they were
+    computed from, so updating the index only re-reads the notebooks that changed, and the
+    index is written once per update.
+    """
+
+    # bumped whenever `search_entry` changes, so entries computed by an older version are recomputed
+    entry_format = 2
+
+    def __init__(self, index_file: Union[Path, str] = SEARCH_INDEX_FILE, state_file: Union[Path, str] = SEARCH_STATE_FILE):
+        self.index_file = Path(index_file)
+        self.state_file = Path(state_file)
+        # a mapping of notebook filepaths to {'version': [mtime, size, entry format], 'entry': search entry, or None for drafts}
+        self.entries: Dict[str, dict] = json.loads(self.state_file.read_text()) if self.state_file.exists() else {}
+
+    def update(self, notebooks: Iterable[Path], prune: bool = True) -> int:
+        """
+        Recompute the entries of the notebooks that changed since they were indexed, and save the index if any did.
+
+        Args:
+            notebooks: the notebooks to index
+            prune: also drop the entries of notebooks not given, e.g. because they were deleted
+
+        Returns: the number of entries added, changed or removed
+        """
+        notebooks = {notebook.as_posix(): notebook for notebook in notebooks}
+        changed = 0
+        for name, notebook in notebooks.items():
+            stat = notebook.stat()
+            version = [stat.st_mtime_ns, stat.st_size, self.entry_format]
+            if self.entries.get(name, {}).get('version') != version:
+                self.entries[name] = {'version': version, 'entry': search_entry(notebook)}
+                changed += 1
+        if prune:
+            for name in set(self.entries) - set(notebooks):
+                del self.entries[name]
+                changed += 1
+        if changed:
+            self.save()
+        return changed
+
+    def remove(self, notebook: Path):
+        """Drop a notebook's entry from the index."""
+        if self.entries.pop(notebook.as_posix(), None) is not None:
+            self.save()
+
+    def save(self):
+        """Write the index, newest posts first, and the state it was computed from."""
+        entries = sorted((indexed['entry'] for indexed in self.entries.values() if indexed['entry'] is not None),
+                         key=lambda entry: str(entry.get('date') or ''), reverse=True)
+        for path, content in ((self.index_file, entries), (self.state_file, self.entries)):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_if_changed(path, json.dumps(content, ensure_ascii=False))
+        print(crayons.green('search index: {} post(s) -> {}'.format(len(entries), self.index_file)))
+
+
+########## Metrics stuff #################
+
+class Metrics:
+    """
+    Thread-safe counters, gauges and per-stage latency histograms, exposed in the prometheus text format.
+
+    Counters are named like prometheus metrics and may carry labels; stage latencies all go
+    in the hugo_jupyter_stage_seconds histogram, labelled by stage.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # a mapping of (name, labels) to the counter's value
+        self.counters: Dict[Tuple[str, tuple], float] = defaultdict(float)
+        # a mapping of stage names to [count per bucket..., count, sum]
+        self.stages: Dict[str, List[float]] = {}
+        # a mapping of gauge names to functions returning their current value
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Increase a counter."""
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += amount
+
+    def observe(self, stage: str, seconds: float):
+        """Record how long a stage took."""
+        with self.lock:
+            observations = self.stages.setdefault(stage, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    observations[index] += 1
+            observations[-2] += 1
+            observations[-1] += seconds
+
+    @contextmanager
+    def time(self, stage: str):
+        """Time the body of a with statement as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def gauge(self, name: str, function: Callable[[], float]):
+        """Register a gauge whose value is read from a function when metrics are collected."""
+        self.gauges[name] = function
+
+    def counter(self, name: str, **labels) -> float:
+        with self.lock:
+            return sum(value for (counter, counter_labels), value in self.counters.items()
+                       if counter == name and set(labels.items()) <= set(counter_labels))
+
+    def exposition(self) -> str:
+        """Return all metrics in the prometheus text exposition format."""
+        def format_labels(labels):
+            return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}' if labels else ''
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append('# TYPE {} counter'.format(name))
+                lines.extend('{}{} {:g}'.format(name, format_labels(labels), value)
+                             for (counter, labels), value in sorted(self.counters.items()) if counter == name)
+            if self.stages:
+                lines.append('# TYPE hugo_jupyter_stage_seconds histogram')
+            for stage, observations in sorted(self.stages.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), observations[:len(self.buckets)] + [observations[-2]]):
+                    lines.append('hugo_jupyter_stage_seconds_bucket{{stage="{}",le="{}"}} {:g}'.format(stage, bound, count))
+                lines.append('hugo_jupyter_stage_seconds_count{{stage="{}"}} {:g}'.format(stage, observations[-2]))
+                lines.append('hugo_jupyter_stage_seconds_sum{{stage="{}"}} {:g}'.format(stage, observations[-1]))
+        for name, function in sorted(self.gauges.items()):
+            lines.extend(('# TYPE {} gauge'.format(name), '{} {:g}'.format(name, function())))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Return a one-line summary of the metrics."""
+        hits, misses = self.counter('hugo_jupyter_body_cache_hits_total'), self.counter('hugo_jupyter_body_cache_misses_total')
+        with self.lock:
+            total = self.stages.get('total', [0] * (len(self.buckets) + 2))
+        return 'renders: {:g} ok, {:g} failed; mean render {:.0f}ms; cache hit ratio {:.0%}; {:g} bytes written'.format(
+            self.counter('hugo_jupyter_renders_total', status='ok'),
+            self.counter('hugo_jupyter_renders_total', status='error'),
+            total[-1] / total[-2] * 1000 if total[-2] else 0,
+            hits / (hits + misses) if hits + misses else 0,
+            self.counter('hugo_jupyter_bytes_written_total'),
+        )
+
+
+METRICS = Metrics()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serve `METRICS` at /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would drown out the render output
+        pass
+
+
+def serve_metrics(port: int) -> HTTPServer:
+    """Serve prometheus metrics on localhost in a background thread."""
+    server = HTTPServer(('localhost', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(crayons.green('serving metrics at http://localhost:{}/metrics'.format(port)))
+    return server
 
 
 ########## Watchdog stuff #################
@@ -271,12 +2038,26 @@ def update_notebook_metadata(notebook: Union[Path, str],
 class NotebookHandler(PatternMatchingEventHandler):
     patterns = ["*.ipynb"]
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(self, *args, **kwargs)
+    def __init__(self, *args,
+                 search_index: Optional['SearchIndex'] = None,
+                 limits: Optional['RenderLimits'] = None,
+                 validation: str = 'cached',
+                 **kwargs):
+        kwargs.setdefault('patterns', self.patterns)
+        super().__init__(*args, **kwargs)
         # a mapping of notebook filepaths and their respective metadata
         self.notebook_metadata: Mapping[str, dict] = {}
         # a mapping of notebook filepaths and where they were rendered to
         self.notebook_render: Mapping[str, Set[Path]] = defaultdict(set)
+        # rendered markdown bodies, so front-matter-only edits don't re-run nbconvert
+        self.markdown_cache = MarkdownCache()
+        # the search index to keep up to date, if any
+        self.search_index = search_index
+        # the limits notebooks are rendered with, and the notebooks that failed to render
+        self.limits = limits
+        self.failures = RenderFailures()
+        # the notebook validation policy
+        self.validation = validation
 
     def process(self, event):
         try:
@@ -284,24 +2065,44 @@ class NotebookHandler(PatternMatchingEventHandler):
             # and render notebook until filename is
             # changed from untitled...
             if 'untitled' not in event.src_path.lower() and '.~' not in event.src_path:
-                self.delete_notebook_md(event)
-
-                # if not self.notebook_metadata.get(event.src_path):
-                #     self.update_notebook_metadata_registry(event.src_path)
 
+                # don't retry notebooks that keep failing on every save
+                if self.failures.is_quarantined(event.src_path):
+                    METRICS.inc('hugo_jupyter_quarantine_skips_total')
+                    print(crayons.yellow('skipping quarantined notebook {} (fab clear_quarantine to retry)'.format(
+                        event.src_path)))
+                    return
 
                 # update metadata registry
                 self.update_notebook_metadata_registry(event)
 
                 render_to = self.get_render_to_field(event)
 
-                rendered = write_hugo_formatted_nb_to_md(event.src_path, render_to=render_to)
+                start = time.time()
+                with METRICS.time('total'):
+                    rendered = write_hugo_formatted_nb_to_md(event.src_path,
+                                                             render_to=render_to,
+                                                             cache=self.markdown_cache,
+                                                             limits=self.limits,
+                                                             validation=self.validation)
+                METRICS.inc('hugo_jupyter_renders_total', status='ok')
+                self.failures.clear(event.src_path)
+                self.report_latency(event, rendered, start)
+
+                # remove posts left behind by a previous slug or render-to directory
+                self.delete_notebook_md(event, keep=rendered)
 
                 self.notebook_render[event.src_path].add(rendered)
 
+                if self.search_index is not None:
+                    self.search_index.update([Path(event.src_path)], prune=False)
+
         except Exception as e:
             print('could not successfully render', event.src_path)
             print(e)
+            METRICS.inc('hugo_jupyter_renders_total', status='error')
+            METRICS.inc('hugo_jupyter_errors_total', kind=getattr(e, 'kind', 'error'))
+            self.failures.record(event.src_path, e)
 
 
     def on_modified(self, event):
@@ -314,18 +2115,28 @@ class NotebookHandler(PatternMatchingEventHandler):
 
     def on_deleted(self, event):
         self.delete_notebook_md(event)
+        self.markdown_cache.bodies.pop(event.src_path, None)
+        if self.search_index is not None:
+            self.search_index.remove(Path(event.src_path))
 
-    def delete_notebook_md(self, event):
-        print(crayons.yellow("attempting to delete the post for {}".format(event.src_path)))
-        for path in self.notebook_render[event.src_path]:
+    def delete_notebook_md(self, event, keep: Optional[Path] = None):
+        for path in self.notebook_render[event.src_path] - {keep}:
+            print(crayons.yellow("attempting to delete the post for {}".format(event.src_path)))
             if path.exists():
                 path.unlink()
                 print(crayons.yellow('removed post: {}'.format(path)))
+        self.notebook_render[event.src_path] &= {keep}
+
+    def report_latency(self, event, rendered: Path, start: float):
+        """Log how long the render took, and how long since the notebook was saved."""
+        now = time.time()
+        saved = Path(event.src_path).stat().st_mtime
+        print(crayons.green('rendered {} -> {} in {:.0f}ms ({:.0f}ms after save)'.format(
+            Path(event.src_path).name, rendered, (now - start) * 1000, (now - saved) * 1000)))
 
     def update_notebook_metadata_registry(self, event):
         try:
-            self.notebook_metadata[event.src_path] = json.loads(
-                Path(event.src_path).read_text())['metadata']
+            self.notebook_metadata[event.src_path] = read_notebook_metadata(event.src_path)
         except json.JSONDecodeError:
             print(crayons.yellow("Could not decode as json file: {}".format(event.src_path)))
 
@@ -336,3 +2147,31 @@ class NotebookHandler(PatternMatchingEventHandler):
             print(crayons.yellow("could not marshal notebook to json: {}".format(event.src_path)))
         except KeyError:
             print("{} has no field hugo-jupyter.render-to in its metadata".format(event.src_path))
+
+
+########## Fabric stuff #################
+
+@singledispatch
+def true(arg):
+    """
+    Determine if the argument is True.
+
+    Since arguments coming from the command line
+    will always be interpreted as strings by fabric,
+    wrap task arguments as `if true(arg): ...`
+    and be aware that true('false') -> False
+
+    Args:
+        arg: anything
+
+    Returns: bool
+
+    """
+    return bool(arg)
+
+
+@true.register(str)
+def _(arg):
+    """If the lowercase string is 't' or 'true', return True else False."""
+    argument = arg.lower().strip()
+    return argument == 'true' or argument == 't'
@@ -2,6 +2,488 @@
 # -*- coding: utf-8 -*-
 
 """Tests for `hugo_jupyter` package."""
+import importlib
+import os
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+nbformat = pytest.importorskip('nbformat')
+pytest.importorskip('fabric.api')
+fabfile = importlib.import_module('hugo_jupyter.__fabfile')
+
+
+@pytest.fixture
+def tmp_path(tmpdir):
+    """tmpdir as a pathlib.Path; pytest's own tmp_path fixture needs pytest 3.9, newer than the pinned version."""
+    return Path(str(tmpdir))
+
+
+def git(*args):
+    """Run git in the current directory and return its output."""
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+                          check=True, stdout=subprocess.PIPE).stdout.decode().strip()
+
+
+def make_notebook(n_cells: int):
+    """Return a notebook with n_cells code cells, every other one blank."""
+    cells = [
+        {'cell_type': 'code', 'execution_count': None, 'metadata': {}, 'outputs': [],
+         'source': '' if index % 2 else '  x = {}  \n'.format(index)}
+        for index in range(n_cells)
+    ]
+    return nbformat.from_dict({'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 2})
+
 
 def test_nothing():
     assert True
+
+
+def test_preprocessor_removes_consecutive_blank_and_tagged_cells():
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell('a = 1\n'),
+        nbformat.v4.new_code_cell(''),
+        nbformat.v4.new_code_cell('   '),
+        nbformat.v4.new_markdown_cell('\n'),
+        nbformat.v4.new_code_cell('secret()', metadata={'tags': ['remove']}),
+        nbformat.v4.new_markdown_cell('hidden', metadata={'tags': ['hide']}),
+        nbformat.v4.new_markdown_cell('# kept'),
+    ])
+
+    nb, _ = fabfile.CustomPreprocessor().preprocess(nb, {})
+
+    assert [cell.source for cell in nb.cells] == ['a = 1', '# kept']
+
+
+def test_preprocessor_filters_cells_in_one_pass_without_mutating_the_cell_list(monkeypatch):
+    class CellList(list):
+        mutations = 0
+
+        def mutate(method):
+            def mutating(self, *args):
+                CellList.mutations += 1
+                return method(self, *args)
+            return mutating
+
+        pop, remove, insert, __delitem__ = map(mutate, (list.pop, list.remove, list.insert, list.__delitem__))
+
+    nb = make_notebook(100)
+    nb.cells = CellList(nb.cells)
+    preprocessor = fabfile.CustomPreprocessor()
+    processed = []
+    preprocess_cell = preprocessor.preprocess_cell
+    monkeypatch.setattr(preprocessor, 'preprocess_cell',
+                        lambda cell, resources, index: processed.append(index) or preprocess_cell(cell, resources, index))
+
+    nb, _ = preprocessor.preprocess(nb, {})
+
+    assert CellList.mutations == 0
+    assert processed == list(range(50)) and len(nb.cells) == 50
+
+
+@pytest.mark.skipif(not os.environ.get('HUGO_JUPYTER_BENCHMARK'), reason='set HUGO_JUPYTER_BENCHMARK=1 to run benchmarks')
+def test_preprocessor_scales_linearly_with_cell_count():
+    preprocessor = fabfile.CustomPreprocessor()
+
+    def best_time(n_cells):
+        timings = []
+        for _ in range(3):
+            nb = make_notebook(n_cells)
+            start = time.perf_counter()
+            preprocessor.preprocess(nb, {})
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    small, large = best_time(4000), best_time(64000)
+
+    # 16x the cells should cost roughly 16x the time; removing cells one by one costs far more
+    assert large / small < 32
+
+
+def test_apply_front_matter_changes_coerces_and_removes_keys():
+    front_matter = {'title': 'post', 'subtitle': 'old'}
+
+    updated = fabfile.apply_front_matter_changes(front_matter, {'tags': 'a; b', 'draft': 'true', 'subtitle': ''})
+
+    assert updated == {'title': 'post', 'tags': ['a', 'b'], 'draft': True}
+
+
+def test_toml_manifest_dates_are_stored_as_iso_strings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notebooks').mkdir()
+    nbformat.write(make_notebook(2), str(tmp_path / 'notebooks' / 'post.ipynb'))
+    (tmp_path / 'fm.toml').write_text('["notebooks/*.ipynb"]\ndate = 2020-01-02\nlastmod = 2020-01-03T04:05:06\n')
+    monkeypatch.setattr(fabfile, 'trust_notebooks', lambda notebooks: None)
+
+    fabfile.update_front_matter(manifest='fm.toml')
+
+    front_matter = fabfile.read_notebook_metadata(tmp_path / 'notebooks' / 'post.ipynb')['front-matter']
+    assert (front_matter['date'], front_matter['lastmod']) == ('2020-01-02', '2020-01-03T04:05:06')
+
+
+def test_front_matter_failures_are_reported_together_and_written_notebooks_trusted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notebooks').mkdir()
+    for name in ('a', 'c'):
+        nbformat.write(make_notebook(2), str(tmp_path / 'notebooks' / (name + '.ipynb')))
+    (tmp_path / 'notebooks' / 'b.ipynb').write_text('not a notebook')
+    trusted = []
+    monkeypatch.setattr(fabfile, 'trust_notebooks', trusted.extend)
+
+    with pytest.raises(SystemExit):
+        fabfile.update_front_matter(notebooks='notebooks', draft='true')
+
+    assert trusted == [Path('notebooks/a.ipynb'), Path('notebooks/c.ipynb')]
+    assert fabfile.read_notebook_metadata(tmp_path / 'notebooks' / 'c.ipynb')['front-matter']['draft'] is True
+
+
+def test_toml_front_matter_header_round_trips_through_split():
+    metadata = {
+        'front-matter': {'title': 'a "post"', 'tags': ['x'], 'draft': False, 'params': {'math': True}},
+        'hugo-jupyter': {'front-matter-format': 'toml'},
+    }
+
+    header = fabfile.front_matter_header(metadata)
+
+    assert header == '\n'.join((
+        '+++',
+        'title = "a \\"post\\""',
+        'tags = ["x"]',
+        'draft = false',
+        '',
+        '[params]',
+        'math = true',
+        '+++',
+    ))
+    assert fabfile.split_front_matter(header + '\n<!--more-->\nbody') == (header, '\n<!--more-->\nbody')
+
+
+def test_site_front_matter_format_only_reads_the_top_level_key(tmp_path):
+    config = tmp_path / 'config.toml'
+    config.write_text('title = "site"\n\n[params]\nmetaDataFormat = "yaml"\n')
+    assert fabfile.site_front_matter_format(config) is None
+
+    config.write_text('metaDataFormat = "TOML"\n\n[params]\nmetaDataFormat = "yaml"\n')
+    os.utime(str(config), (0, 1))
+    assert fabfile.site_front_matter_format(config) == 'toml'
+
+
+def test_markdown_cache_only_rerenders_changed_cells():
+    cache = fabfile.MarkdownCache()
+    nb = make_notebook(4)
+
+    first = cache.body('post.ipynb', nb)
+    nb.metadata['front-matter'] = {'title': 'changed'}
+    assert cache.body('post.ipynb', nb) == first
+    nb.cells[0].source = 'y = 1'
+    assert cache.body('post.ipynb', nb) != first
+
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_rendering_an_unchanged_notebook_leaves_the_post_alone(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fabfile, 'trust_notebooks', lambda notebooks: None)
+    nb = make_notebook(4)
+    nb.metadata['front-matter'] = {'title': 'post', 'slug': 'post', 'date': '2017-01-01'}
+    nbformat.write(nb, 'post.ipynb')
+
+    post = fabfile.write_hugo_formatted_nb_to_md('post.ipynb', render_to='content/post')
+    os.utime(str(post), (0, 1))
+    markdown = post.read_text()
+
+    assert fabfile.write_hugo_formatted_nb_to_md('post.ipynb', render_to='content/post') == post
+    assert post.stat().st_mtime == 1
+    assert not fabfile.write_if_changed(post, markdown)
+    assert fabfile.write_if_changed(post, markdown + '\n') and post.stat().st_mtime != 1
+
+
+def test_notebook_metadata_is_spliced_without_touching_cells(tmp_path):
+    notebook_file = tmp_path / 'post.ipynb'
+    nb = make_notebook(10)
+    nb.metadata['kernelspec'] = {'name': 'python3'}
+    nbformat.write(nb, str(notebook_file))
+
+    assert fabfile.read_notebook_metadata(notebook_file) == {'kernelspec': {'name': 'python3'}}
+
+    fabfile.write_notebook_metadata(notebook_file, {'front-matter': {'title': 'spliced'}})
+
+    written = nbformat.read(str(notebook_file), as_version=4)
+    assert written.metadata == {'front-matter': {'title': 'spliced'}}
+    assert written.cells == nb.cells
+
+
+def test_partition_notebooks_balances_by_weight_not_count():
+    weights = {Path('big.ipynb'): 10, Path('a.ipynb'): 4, Path('b.ipynb'): 3, Path('c.ipynb'): 3}
+
+    shards = fabfile.partition_notebooks(list(weights), 2, weights)
+
+    assert shards == [[Path('big.ipynb')], [Path('a.ipynb'), Path('b.ipynb'), Path('c.ipynb')]]
+
+
+def test_render_weights_use_committed_sizes_that_rendering_does_not_change(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notebooks').mkdir()
+    for name, n_cells in (('big', 40), ('small', 10)):
+        nbformat.write(make_notebook(n_cells), 'notebooks/{}.ipynb'.format(name))
+    git('init', '-q')
+    git('add', 'notebooks')
+    git('commit', '-qm', 'notebooks')
+    notebooks = fabfile.notebooks_to_render()
+    weights = fabfile.render_weights(notebooks)
+
+    # e.g. a shard rendering `small` first writes front matter into it
+    fabfile.write_notebook_metadata('notebooks/small.ipynb', {'front-matter': {'title': 'x' * 10000}})
+
+    assert fabfile.render_weights(notebooks) == weights
+    assert weights[Path('notebooks/big.ipynb')] > weights[Path('notebooks/small.ipynb')]
+
+
+def test_changed_notebooks_and_stale_posts_since_a_commit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notebooks').mkdir()
+    (tmp_path / 'content' / 'post').mkdir(parents=True)
+    for name in ('modified', 'reslugged', 'renamed', 'deleted'):
+        nb = make_notebook(20)
+        nb.metadata['front-matter'] = {'title': name, 'slug': name}
+        nbformat.write(nb, 'notebooks/{}.ipynb'.format(name))
+        (tmp_path / 'content' / 'post' / (name + '.md')).write_text(name)
+    git('init', '-q')
+    git('add', 'notebooks')
+    git('commit', '-qm', 'first')
+    since = git('rev-parse', 'HEAD')
+
+    nbformat.write(make_notebook(4), 'notebooks/modified.ipynb')
+    fabfile.write_notebook_metadata('notebooks/reslugged.ipynb', {'front-matter': {'title': 'new', 'slug': 'new-slug'}})
+    git('mv', 'notebooks/renamed.ipynb', 'notebooks/moved.ipynb')
+    git('rm', '-q', 'notebooks/deleted.ipynb')
+    git('commit', '-qam', 'second')
+
+    changed, removed = fabfile.changed_notebooks(since)
+    assert changed == {Path('notebooks/modified.ipynb'), Path('notebooks/reslugged.ipynb'), Path('notebooks/moved.ipynb')}
+    assert sorted(removed) == [Path('notebooks/deleted.ipynb'), Path('notebooks/renamed.ipynb')]
+
+    fabfile.remove_stale_posts(since, removed, changed)
+    assert sorted(path.name for path in (tmp_path / 'content' / 'post').iterdir()) == ['modified.md']
+
+
+def test_script_bundles_are_written_once_and_included_once_per_page(tmp_path):
+    library = '/* plotly.js v1.2.3 */' + 'x' * 30000
+    html = '<div id="plot"></div><script type="text/javascript">{}</script>'.format(library)
+    cells = [nbformat.v4.new_code_cell('plot()', outputs=[
+        nbformat.v4.new_output('display_data', data={'text/html': html})]) for _ in range(2)]
+    nb = nbformat.v4.new_notebook(cells=cells)
+
+    preprocessor = fabfile.ScriptBundlePreprocessor(static_dir=str(tmp_path))
+    nb, _ = preprocessor.preprocess(nb, {})
+
+    bundle, = (tmp_path / 'hugo-jupyter' / 'bundles').iterdir()
+    assert bundle.name.startswith('plotly-') and bundle.read_text() == library
+    assert nb.cells[0].outputs[0].data['text/html'] == (
+        '<div id="plot"></div><script src="/hugo-jupyter/bundles/{}"></script>'.format(bundle.name))
+    assert nb.cells[1].outputs[0].data['text/html'] == '<div id="plot"></div>'
+
+
+def test_images_are_extracted_once_and_cached(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    import base64
+    from io import BytesIO
+
+    png = BytesIO()
+    Image.new('RGB', (1200, 600), 'red').save(png, 'PNG')
+    data = base64.b64encode(png.getvalue()).decode()
+    cells = [nbformat.v4.new_code_cell('plot()', outputs=[
+        nbformat.v4.new_output('display_data', data={'image/png': data, 'text/plain': '<Figure "plot">'})]) for _ in range(2)]
+    cells.append(nbformat.v4.new_code_cell('widget()', outputs=[
+        nbformat.v4.new_output('display_data', data={'image/png': data, 'text/html': '<b>widget</b>'})]))
+
+    preprocessor = fabfile.ImagePreprocessor(static_dir=str(tmp_path), widths=[480])
+    nb, _ = preprocessor.preprocess(nbformat.v4.new_notebook(cells=cells), {})
+
+    html = nb.cells[0].outputs[0].data['text/html']
+    assert 'image/png' not in nb.cells[0].outputs[0].data
+    assert html.startswith('<picture><source type="image/webp"') and 'loading="lazy"' in html
+    assert 'alt="&lt;Figure &quot;plot&quot;&gt;"' in html
+    assert nb.cells[1].outputs[0].data['text/html'] == html
+    assert nb.cells[2].outputs[0].data == {'image/png': data, 'text/html': '<b>widget</b>'}
+    written = sorted(path.suffix for path in (tmp_path / 'hugo-jupyter' / 'images').iterdir())
+    assert written == ['.json', '.png', '.png', '.webp', '.webp']
+    name = html.split('-480.png')[0].rsplit('/', 1)[1]
+    assert preprocessor.cached(name)['width'] == 1200
+
+
+def test_highlighted_code_is_one_html_block_and_hides_the_source(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('a = 1\n\nb = 2')])
+
+    nb, _ = fabfile.HighlightPreprocessor().preprocess(nb, {})
+
+    highlighted, code = nb.cells
+    assert highlighted.source.startswith('<div class="highlight"')
+    assert 'data-lang="python"' in highlighted.source
+    assert all(line.strip() for line in highlighted.source.splitlines())
+    assert '<code class="language-python" data-lang="python">' in highlighted.source
+    assert highlighted.source.endswith('</code></pre></div>')
+    assert code.transient == code.metadata.transient == {'remove_source': True}
+    assert len(list((tmp_path / '.hugo_jupyter' / 'highlight').iterdir())) == 1
+
+
+def test_search_index_only_recomputes_changed_notebooks(tmp_path):
+    notebooks = []
+    for name in ('first', 'second'):
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_markdown_cell('About [Hugo](https://gohugo.io) <b>sites</b>')])
+        nb.metadata['front-matter'] = {'title': name, 'slug': name, 'date': '2017-01-01'}
+        nbformat.write(nb, str(tmp_path / (name + '.ipynb')))
+        notebooks.append(tmp_path / (name + '.ipynb'))
+    index = fabfile.SearchIndex(tmp_path / 'static' / 'index.json', tmp_path / 'state.json')
+
+    assert index.update(notebooks) == 2
+    assert fabfile.SearchIndex(tmp_path / 'static' / 'index.json', tmp_path / 'state.json').update(notebooks) == 0
+    assert index.update(notebooks[:1]) == 1
+
+    entry, = fabfile.json.loads((tmp_path / 'static' / 'index.json').read_text())
+    assert entry == {'title': 'first', 'slug': 'first', 'date': '2017-01-01',
+                     'summary': 'About Hugo sites', 'tokens': ['about', 'hugo', 'sites']}
+
+
+def test_search_index_leaves_out_hidden_cells_and_drafts(tmp_path):
+    for name, draft in (('post', False), ('draft', True)):
+        nb = nbformat.v4.new_notebook(cells=[
+            nbformat.v4.new_markdown_cell('Public text'),
+            nbformat.v4.new_markdown_cell('SECRET draft notes', metadata={'tags': ['remove']}),
+            nbformat.v4.new_markdown_cell('hidden words', metadata={'tags': ['hide']}),
+        ])
+        nb.metadata['front-matter'] = {'title': name, 'slug': name, 'draft': draft}
+        nbformat.write(nb, str(tmp_path / (name + '.ipynb')))
+    index = fabfile.SearchIndex(tmp_path / 'index.json', tmp_path / 'state.json')
+
+    assert index.update([tmp_path / 'post.ipynb', tmp_path / 'draft.ipynb']) == 2
+
+    entry, = fabfile.json.loads((tmp_path / 'index.json').read_text())
+    assert (entry['slug'], entry['summary'], entry['tokens']) == ('post', 'Public text', ['public', 'text'])
+
+
+@pytest.mark.skipif(fabfile.resource is None, reason='rlimits are not available on this platform')
+def test_render_limits_stop_slow_and_memory_hungry_work():
+    limits = fabfile.RenderLimits(timeout=0.5, memory_limit=512)
+
+    assert limits.run(sum, [1, 2, 3]) == 6
+    with pytest.raises(fabfile.RenderFailure) as timed_out:
+        limits.run(time.sleep, 10)
+    assert timed_out.value.kind == 'timeout'
+    with pytest.raises(fabfile.RenderFailure) as out_of_memory:
+        limits.run(bytearray, 4 * 1024 ** 3)
+    assert out_of_memory.value.kind == 'memory'
+
+
+def test_notebooks_are_quarantined_after_repeated_failures(tmp_path):
+    failures = fabfile.RenderFailures(tmp_path / 'failures.json', quarantine_after=2)
+
+    failures.record('post.ipynb', fabfile.RenderFailure('timeout', 'took too long'))
+    assert not failures.is_quarantined('post.ipynb')
+    failures.record('post.ipynb', ValueError('bad'))
+    assert fabfile.RenderFailures(tmp_path / 'failures.json').is_quarantined('post.ipynb')
+
+    failures.clear('post.ipynb')
+    assert not fabfile.RenderFailures(tmp_path / 'failures.json').is_quarantined('post.ipynb')
+
+
+def test_quarantine_cleared_by_another_process_is_not_written_back(tmp_path):
+    watcher = fabfile.RenderFailures(tmp_path / 'failures.json', quarantine_after=1)
+    watcher.record('post.ipynb', ValueError('bad'))
+    assert watcher.is_quarantined('post.ipynb')
+
+    # e.g. `fab clear_quarantine` while `fab serve` is running
+    fabfile.RenderFailures(tmp_path / 'failures.json').clear('post.ipynb')
+
+    assert not watcher.is_quarantined('post.ipynb')
+    watcher.record('other.ipynb', ValueError('bad'))
+    assert list(fabfile.RenderFailures(tmp_path / 'failures.json').records) == ['other.ipynb']
+
+
+def test_metrics_exposition_and_summary():
+    metrics = fabfile.Metrics()
+    metrics.inc('hugo_jupyter_renders_total', status='ok')
+    metrics.inc('hugo_jupyter_body_cache_hits_total', 3)
+    metrics.inc('hugo_jupyter_body_cache_misses_total')
+    metrics.observe('total', 0.2)
+    metrics.gauge('hugo_jupyter_queue_depth', lambda: 4)
+
+    exposition = metrics.exposition().splitlines()
+
+    assert 'hugo_jupyter_renders_total{status="ok"} 1' in exposition
+    assert 'hugo_jupyter_stage_seconds_bucket{stage="total",le="0.1"} 0' in exposition
+    assert 'hugo_jupyter_stage_seconds_bucket{stage="total",le="0.25"} 1' in exposition
+    assert 'hugo_jupyter_stage_seconds_count{stage="total"} 1' in exposition
+    assert 'hugo_jupyter_queue_depth 4' in exposition
+    assert metrics.summary() == ('renders: 1 ok, 0 failed; mean render 200ms; '
+                                 'cache hit ratio 75%; 0 bytes written')
+
+
+def test_validation_is_cached_by_content_and_errors_are_collected(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    valid, invalid = tmp_path / 'valid.ipynb', tmp_path / 'invalid.ipynb'
+    nbformat.write(make_notebook(2), str(valid))
+    invalid_notebook = make_notebook(2)
+    invalid_notebook.cells[0]['unexpected'] = True
+    invalid.write_text(nbformat.writes(invalid_notebook, version=4))
+    calls = []
+    monkeypatch.setattr(fabfile.nbformat, 'validate', lambda nb, validate=nbformat.validate: calls.append(nb) or validate(nb))
+
+    for _ in range(2):
+        fabfile.load_notebook(valid)
+        fabfile.load_notebook(invalid)
+    fabfile.load_notebook(valid, 'full')
+    fabfile.load_notebook(valid, 'skip')
+
+    assert len(calls) == 3
+    assert list(fabfile.NotebookValidations().errors([valid, invalid])) == [invalid.as_posix()]
+
+
+def test_validate_notebooks_reports_unreadable_notebooks_with_the_rest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notebooks').mkdir()
+    nbformat.write(make_notebook(2), 'notebooks/valid.ipynb')
+    (tmp_path / 'notebooks' / 'broken.ipynb').write_text('{not json')
+    invalid_notebook = make_notebook(2)
+    invalid_notebook.cells[0]['unexpected'] = True
+    (tmp_path / 'notebooks' / 'invalid.ipynb').write_text(nbformat.writes(invalid_notebook, version=4))
+
+    with pytest.raises(SystemExit):
+        fabfile.validate_notebooks()
+
+    errors = fabfile.NotebookValidations().errors(fabfile.notebooks_to_render())
+    assert sorted(errors) == ['notebooks/broken.ipynb', 'notebooks/invalid.ipynb']
+    assert errors['notebooks/broken.ipynb'].startswith('NotJSONError')
+
+
+def test_front_matter_only_edits_are_not_revalidated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    notebook_file = tmp_path / 'post.ipynb'
+    nbformat.write(make_notebook(2), str(notebook_file))
+    calls = []
+    monkeypatch.setattr(fabfile.nbformat, 'validate', lambda nb, validate=nbformat.validate: calls.append(nb) or validate(nb))
+
+    fabfile.load_notebook(notebook_file)
+    fabfile.write_notebook_metadata(notebook_file, {'front-matter': {'title': 'changed'}})
+    fabfile.load_notebook(notebook_file)
+    assert len(calls) == 1
+
+    fabfile.write_notebook_metadata(notebook_file, {'front-matter': {'title': 'changed'}, 'kernelspec': {'name': 'python3'}})
+    fabfile.load_notebook(notebook_file)
+    assert len(calls) == 2
+
+
+def test_markdown_body_only_revalidates_after_each_preprocessor_under_full_validation(monkeypatch):
+    nb = make_notebook(4)
+    calls = []
+    monkeypatch.setattr(nbformat, 'validate', lambda *args, validate=nbformat.validate, **kwargs:
+                        calls.append(args) or validate(*args, **kwargs))
+
+    body = fabfile.markdown_body(nb, 'full')
+    validated = len(calls)
+    assert fabfile.markdown_body(nb, 'cached') == fabfile.markdown_body(nb, 'skip') == body
+
+    assert validated > 0 and len(calls) == validated